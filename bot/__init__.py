@@ -1,14 +1,17 @@
 import logging
 import telebot
 
+from telebot import apihelper
 from telebot.storage import StateMemoryStorage
 from telebot.handler_backends import State, StatesGroup
 
 from django.conf import settings
 
-# Получение комманд
-commands = settings.BOT_COMMANDS
 state_storage = StateMemoryStorage()
+# Подключение к другому адресу Bot API (локальная имитация для нагрузочных прогонов)
+if settings.BOT_API_URL:
+    apihelper.API_URL = f'{settings.BOT_API_URL.rstrip("/")}/bot{{0}}/{{1}}'
+    apihelper.FILE_URL = f'{settings.BOT_API_URL.rstrip("/")}/file/bot{{0}}/{{1}}'
 # Инициализация бота
 bot = telebot.TeleBot(
     settings.BOT_TOKEN,
@@ -22,10 +25,7 @@ class SettingsStates(StatesGroup):
     tone = State()
     timezone = State()
 
-# Установка комманд для бота
-bot.set_my_commands(commands)
-
-logging.info(f'@{bot.get_me().username} started')
+# Команды и getMe при импорте не вызываются: это делает bot_setup (см. bot.services.identity)
 
 logger = telebot.logger
 logger.setLevel(logging.INFO)
@@ -1,5 +1,5 @@
 from django.contrib import admin
 
-from .models import Reminder, Task, UserProfile
+from .models import DeliveryHistory, DispatchTick, IncomingUpdate, Outbox, Reminder, Task, UpdateWatermark, UserProfile
 
-admin.site.register([Reminder, Task, UserProfile])
\ No newline at end of file
+admin.site.register([Reminder, Task, UserProfile, Outbox, DeliveryHistory, DispatchTick, UpdateWatermark, IncomingUpdate])
\ No newline at end of file
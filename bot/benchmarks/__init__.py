@@ -0,0 +1,3 @@
+'''
+    Нагрузочные сценарии для рассылки напоминаний
+'''
@@ -0,0 +1,205 @@
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# Методы, которые просто подтверждаются
+ACKNOWLEDGED = {'deleteMessage', 'answerCallbackQuery', 'sendChatAction', 'setWebhook', 'deleteWebhook', 'setMyCommands'}
+# Методы, для которых действуют лимиты отправки
+LIMITED = {'sendMessage', 'editMessageText'}
+
+
+class FakeBotAPI:
+    '''
+        Имитация Bot API для нагрузочных прогонов: задержка ответа, случайные 429 и лимиты на чат и на бота.
+        Ничего никуда не отправляет, только считает вызовы
+    '''
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0, chat_rate: float = None,
+                 global_rate: float = None, retry_after: int = 1, file_size: int = 16 * 1024, seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.chat_rate = chat_rate
+        self.global_rate = global_rate
+        self.retry_after = retry_after
+        self.file_size = file_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Очередь входящих обновлений для getUpdates
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.updates_ready = threading.Condition(self.lock)
+        self.message_ids = itertools.count(1)
+        self.chat_sent_at = {}
+        self.global_window = (0, 0)
+        self.webhook_url = ''
+        self.calls = Counter()
+        self.rejected = Counter()
+
+    def too_many_requests(self, reason: str) -> tuple[int, dict]:
+        self.rejected[reason] += 1
+        return 429, {
+            'ok': False,
+            'error_code': 429,
+            'description': f'Too Many Requests: retry after {self.retry_after}',
+            'parameters': {'retry_after': self.retry_after},
+        }
+
+    def check_limits(self, chat_id) -> tuple[int, dict]:
+        '''
+            Проверка лимитов до отправки: случайная ошибка, лимит бота в секунду, лимит чата
+        '''
+        now = time.monotonic()
+        with self.lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                return self.too_many_requests('injected')
+            if self.global_rate:
+                second, count = self.global_window
+                if int(now) != second:
+                    second, count = int(now), 0
+                if count >= self.global_rate:
+                    return self.too_many_requests('global')
+                self.global_window = (second, count + 1)
+            if self.chat_rate:
+                last = self.chat_sent_at.get(chat_id)
+                if last is not None and now - last < 1 / self.chat_rate:
+                    return self.too_many_requests('chat')
+                self.chat_sent_at[chat_id] = now
+        return None
+
+    def message(self, params: dict) -> dict:
+        chat_id = int(params.get('chat_id', 0))
+        return {
+            'message_id': int(params.get('message_id') or next(self.message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text', ''),
+        }
+
+    def push_update(self, chat_id: int, text: str) -> int:
+        '''
+            Входящее текстовое сообщение от пользователя, которое бот получит через getUpdates
+        '''
+        with self.updates_ready:
+            update_id = next(self.update_ids)
+            self.updates.append({
+                'update_id': update_id,
+                'message': {
+                    'message_id': next(self.message_ids),
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user_{chat_id}'},
+                    'text': text,
+                },
+            })
+            self.updates_ready.notify_all()
+        return update_id
+
+    def get_updates(self, params: dict) -> list:
+        '''
+            Как в Bot API: обновления с номером меньше offset считаются подтверждёнными и удаляются,
+            при пустой очереди запрос ждёт до timeout секунд
+        '''
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self.updates_ready:
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.updates_ready.wait(deadline - time.monotonic())
+            return self.updates[:limit]
+
+    def handle(self, method: str, params: dict) -> tuple[int, dict]:
+        '''
+            Ответ на вызов метода: (HTTP-статус, JSON)
+        '''
+        with self.lock:
+            self.calls[method] += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self.random.uniform(0, self.jitter))
+
+        if method in LIMITED:
+            rejected = self.check_limits(params.get('chat_id'))
+            if rejected:
+                return rejected
+            return 200, {'ok': True, 'result': self.message(params)}
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url', '')
+        if method in ACKNOWLEDGED:
+            return 200, {'ok': True, 'result': True}
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self.get_updates(params)}
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}}
+        if method == 'getFile':
+            file_id = params.get('file_id', 'file')
+            return 200, {'ok': True, 'result': {
+                'file_id': file_id, 'file_unique_id': file_id, 'file_size': self.file_size, 'file_path': f'voice/{file_id}.ogg',
+            }}
+        return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}
+
+    def file(self, path: str) -> bytes:
+        with self.lock:
+            self.calls['file'] += 1
+        return os.urandom(self.file_size)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'calls': dict(self.calls), 'rejected': dict(self.rejected), 'webhook_url': self.webhook_url, 'pending_updates': len(self.updates)}
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    '''
+        HTTP-обёртка: /bot<токен>/<метод>, /file/bot<токен>/<путь> и /stats
+    '''
+    api: FakeBotAPI = None
+
+    def params(self) -> dict:
+        # telebot передаёт параметры в строке запроса, остальные клиенты - в теле
+        params = dict(parse_qsl(urlsplit(self.path).query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith('application/json'):
+                params.update(json.loads(body))
+            elif content_type.startswith('application/x-www-form-urlencoded'):
+                params.update(parse_qsl(body.decode()))
+        return params
+
+    def reply(self, status: int, body: bytes, content_type: str = 'application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self):
+        path = urlsplit(self.path).path.strip('/').split('/')
+        if path == ['stats']:
+            return self.reply(200, json.dumps(self.api.stats()).encode())
+        if len(path) >= 3 and path[0] == 'file' and path[1].startswith('bot'):
+            return self.reply(200, self.api.file('/'.join(path[2:])), 'application/octet-stream')
+        if len(path) == 2 and path[0].startswith('bot'):
+            status, payload = self.api.handle(path[1], self.params())
+            return self.reply(status, json.dumps(payload, ensure_ascii=False).encode())
+        self.reply(404, b'{"ok": false, "error_code": 404, "description": "Not Found"}')
+
+    do_GET = dispatch
+    do_POST = dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(api: FakeBotAPI, host: str = '127.0.0.1', port: int = 8081) -> ThreadingHTTPServer:
+    handler = type('Handler', (FakeBotAPIHandler,), {'api': api})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
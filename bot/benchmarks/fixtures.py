@@ -0,0 +1,134 @@
+import datetime
+import random
+
+from django.utils import timezone
+
+from ..models import Reminder, Task, UserProfile
+from ..services.recurrence import REPEAT_PERIODS, next_occurrence
+
+# Первый ID синтетических пользователей, чтобы не пересекаться с настоящими
+FIRST_USER_ID = 10 ** 9
+
+
+def create_users(count: int) -> list[int]:
+    '''
+        Создание синтетических пользователей
+    '''
+    start = FIRST_USER_ID + UserProfile.objects.filter(user_id__gte=FIRST_USER_ID).count()
+    users = [
+        UserProfile(user_id=start + i, username=f'bench_{start + i}', addressing='ty', tone='neutral', timezone='+3')
+        for i in range(count)
+    ]
+    UserProfile.objects.bulk_create(users, batch_size=5000)
+    return [user.user_id for user in users]
+
+
+def create_items(user_ids: list[int], count: int, now: datetime.datetime, due: int = 0, seed: int = 0):
+    '''
+        Создание count напоминаний и count задач.
+        Первые due штук каждой модели готовы к отправке, остальные либо в будущем, либо уже отправлены
+    '''
+    rng = random.Random(seed)
+    reminders = []
+    tasks = []
+    for i in range(count):
+        if i < due:
+            reminder_time = now - datetime.timedelta(minutes=rng.randint(0, 30))
+            sent = False
+        elif rng.random() < 0.5:
+            reminder_time = now + datetime.timedelta(minutes=rng.randint(20, 60 * 24 * 30))
+            sent = False
+        else:
+            reminder_time = now - datetime.timedelta(minutes=rng.randint(20, 60 * 24 * 30))
+            sent = True
+        common = dict(
+            user_id=rng.choice(user_ids),
+            text=f'Синтетическое напоминание {i}',
+            reminder_time=reminder_time,
+            pre_reminder_time=reminder_time - datetime.timedelta(minutes=15),
+            is_pre_reminder_sent=sent,
+            is_main_reminder_sent=sent,
+            created_at=now,
+        )
+        reminders.append(Reminder(**common))
+        tasks.append(Task(is_completed=sent, is_transfered=False, **common))
+
+    # bulk_create не вызывает save(), поэтому next_fire_at считается вручную
+    for item in reminders + tasks:
+        item.update_next_fire()
+
+    Reminder.objects.bulk_create(reminders, batch_size=5000)
+    Task.objects.bulk_create(tasks, batch_size=5000)
+
+
+# Часы, на которые пользователи чаще всего ставят напоминания, и их доля; остальное - равномерно по суткам
+PEAK_HOURS = ((8, 0.25), (9, 0.2), (13, 0.1), (19, 0.1), (22, 0.15))
+REMINDER_REPEATS = ((None, 0.7), ('daily', 0.2), ('weekly', 0.1))
+TASK_REPEATS = ((None, 0.6), ('daily', 0.15), ('daily_morning', 0.1), ('daily_evening', 0.05), ('weekly', 0.1))
+TEXTS = ('выпить витамины', 'позвонить маме', 'встреча с командой', 'оплатить счета', 'зарядка', 'купить хлеб')
+
+
+def pick(rng: random.Random, weights: tuple):
+    value = rng.random()
+    for choice, weight in weights:
+        value -= weight
+        if value < 0:
+            return choice
+    return weights[-1][0]
+
+
+def realistic_time(rng: random.Random, day: datetime.datetime, days: int) -> datetime.datetime:
+    '''
+        Время напоминания в пределах ±days дней от day: пики в популярные часы, чаще всего ровно в :00 или :30
+    '''
+    hour = pick(rng, PEAK_HOURS)
+    if hour is None:
+        hour = rng.randrange(24)
+        minute = rng.randrange(60)
+    else:
+        minute = rng.choice((0, 0, 0, 30, rng.randrange(60)))
+    return day + datetime.timedelta(days=rng.randint(-days, days), hours=hour, minutes=minute)
+
+
+def create_population(rows: int, now: datetime.datetime, users: int = None, days: int = 30, seed: int = 0, chunk: int = 50000) -> list[int]:
+    '''
+        Реалистичная нагрузка: rows строк Reminder и Task поровну, по умолчанию 20 строк на пользователя.
+        Разовые элементы в прошлом уже отправлены (задачи частью выполнены), повторяющиеся переведены на ближайшее повторение,
+        элементы за последние 2 минуты ещё не отправлены. Строки создаются порциями по chunk, чтобы не держать все в памяти
+    '''
+    rng = random.Random(seed)
+    user_ids = create_users(users or max(rows // 20, 1))
+    day = timezone.localtime(now).replace(hour=0, minute=0, second=0, microsecond=0)
+    due_from = now - datetime.timedelta(minutes=2)
+
+    for start in range(0, rows, chunk):
+        reminders = []
+        tasks = []
+        for i in range(start, min(start + chunk, rows)):
+            is_task = i % 2 == 1
+            repeat_type = pick(rng, TASK_REPEATS if is_task else REMINDER_REPEATS)
+            reminder_time = realistic_time(rng, day, days)
+            if repeat_type and reminder_time <= due_from:
+                reminder_time = next_occurrence(reminder_time, repeat_type, due_from)
+            sent = reminder_time <= due_from
+            fields = dict(
+                user_id=rng.choice(user_ids),
+                text=rng.choice(TEXTS),
+                reminder_time=reminder_time,
+                pre_reminder_time=reminder_time - datetime.timedelta(minutes=15),
+                is_pre_reminder_sent=sent,
+                is_main_reminder_sent=sent,
+                created_at=now,
+                repeat_type=repeat_type,
+                repeat_time=reminder_time + REPEAT_PERIODS[repeat_type] if repeat_type else None,
+            )
+            if is_task:
+                tasks.append(Task(is_completed=sent and rng.random() < 0.6, is_transfered=False, **fields))
+            else:
+                reminders.append(Reminder(**fields))
+
+        for item in reminders + tasks:
+            item.update_next_fire()
+        Reminder.objects.bulk_create(reminders, batch_size=5000)
+        Task.objects.bulk_create(tasks, batch_size=5000)
+    return user_ids
@@ -0,0 +1,423 @@
+import contextlib
+import io
+import statistics
+import threading
+import time
+from types import SimpleNamespace
+
+import datetime
+import random
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count
+from django.utils import timezone
+from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from ..models import Outbox, Reminder, Task, UserProfile
+from ..services.delivery import DeliveryPool
+from ..services.dryrun import QueryTimer
+from ..services.due import DueItems, collect_due
+from ..services.outbox import drain_outbox, enqueue_due, render_due
+from ..services.parser import parse_reminder_time
+from ..services.retention import purge_finished
+from ..services.metrics import percentile
+from ..services.templates import render_message, task_markup
+from ..services.updates import UpdateExecutor
+from .fixtures import create_items, create_population, create_users
+
+
+def measure(func, repeat: int) -> float:
+    '''
+        Медиана времени выполнения func в миллисекундах
+    '''
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def bench_due(sizes: list[int], repeat: int = 5, due: int = 50) -> list[dict]:
+    '''
+        Время выборки готовых к отправке элементов при растущей таблице.
+        Количество готовых элементов постоянно, растёт только "фон"
+    '''
+    now = timezone.now()
+    user_ids = create_users(1000)
+    results = []
+    created = 0
+    for size in sorted(sizes):
+        create_items(user_ids, size - created, now, due=due if created == 0 else 0, seed=size)
+        created = size
+        results.append({
+            'scenario': 'due',
+            'size': size,
+            'ms': round(measure(lambda: collect_due(now=now), repeat), 3),
+        })
+    return results
+
+
+class SlowBot:
+    '''
+        Имитация Bot API с фиксированной задержкой ответа
+    '''
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def send_message(self, chat_id, text, **kwargs):
+        time.sleep(self.latency)
+
+
+def bench_delivery(sizes: list[int], repeat: int = 1, chats: int = 1000, latency: float = 0.05) -> list[dict]:
+    '''
+        Пропускная способность пула отправки при заданной задержке ответа API
+    '''
+    results = []
+    for size in sizes:
+        pool = DeliveryPool(SlowBot(latency))
+        futures = [pool.submit(chat_id=i % chats, text='Бенчмарк') for i in range(size)]
+        for future in futures:
+            future.result()
+        pool.close()
+        stats = pool.stats.snapshot()
+        results.append({
+            'scenario': 'delivery',
+            'size': size,
+            'ms': stats['elapsed_s'] * 1000,
+            **stats,
+        })
+    return results
+
+
+def bench_workers(sizes: list[int], repeat: int = 1, messages: int = 2000, latency: float = 0.01) -> list[dict]:
+    '''
+        Масштабирование разбора Outbox по числу процессов-обработчиков (sizes - числа обработчиков).
+        Каждый обработчик работает в своём потоке со своим соединением с базой.
+        Лимит бота здесь снят, чтобы измерить саму очередь: в работе все обработчики вместе
+        не отправят больше DELIVERY_GLOBAL_RATE сообщений в секунду (ceiling в результате)
+    '''
+    results = []
+    now = timezone.now()
+    for workers in sizes:
+        Outbox.objects.bulk_create([
+            Outbox(key=f'bench:{workers}:{i}', chat_id=i, kind='reminder', item_id=i, text='Бенчмарк', due_at=now)
+            for i in range(messages)
+        ], batch_size=500)
+        bot = SlowBot(latency)
+        sent = []
+
+        def work(index):
+            pool = DeliveryPool(bot, workers=1, global_rate=10 ** 6, chat_rate=10 ** 6)
+            try:
+                # Сценарий идёт вне транзакции: берём только свои строки, настоящая очередь не трогается
+                sent.append(drain_outbox(pool, worker=f'bench-{index}', batch_size=20, key_prefix=f'bench:{workers}:')['sent'])
+            finally:
+                pool.close()
+                connection.close()
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(workers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        Outbox.objects.filter(key__startswith=f'bench:{workers}:').delete()
+
+        results.append({
+            'scenario': 'workers',
+            'size': workers,
+            'ms': round(elapsed * 1000, 3),
+            'sent': sum(sent),
+            'throughput': round(sum(sent) / elapsed, 3),
+            'ceiling': settings.DELIVERY_GLOBAL_RATE,
+        })
+    return results
+
+
+def legacy_render(item, kind: str) -> tuple:
+    '''
+        Прежний способ: цепочка if/elif для повторения и новая клавиатура на каждую задачу
+    '''
+    repeat_info = ""
+    if item.repeat_type == 'daily':
+        repeat_info = " 🔄 (повторится завтра)"
+    elif item.repeat_type == 'weekly':
+        repeat_info = " 🔄 (повторится через неделю)"
+    text = f"🔔 Время пришло!{repeat_info}\n📝 {item.text}"
+    if kind != 'task':
+        return text, None
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton(text="✅ Завершить!", callback_data=f"t.finish|{item.id}"))
+    markup.add(InlineKeyboardButton(text="⏳ Отложить", callback_data=f"t.put_off|{item.id}"))
+    markup.add(InlineKeyboardButton(text="❌ Удалить", callback_data=f"t.remove|{item.id}"))
+    return text, markup.to_json()
+
+
+def bench_render(sizes: list[int], repeat: int = 5) -> list[dict]:
+    '''
+        Стоимость рендеринга сообщений рассылки (без базы): шаблоны против прежнего способа.
+        Половина элементов - задачи с клавиатурой, обращение и тон выбираются случайно
+    '''
+    randomizer = random.Random(0)
+    now = timezone.now()
+    users = [
+        UserProfile(user_id=i, addressing=addressing, tone=tone)
+        for i, (addressing, tone) in enumerate((a, t) for a in ('ty', 'vy') for t in ('business', 'friendly', 'neutral'))
+    ]
+    results = []
+    for size in sizes:
+        reminders, tasks = [], []
+        for i in range(size):
+            model, items = (Reminder, reminders) if i % 2 else (Task, tasks)
+            item = model(
+                id=i + 1, user=randomizer.choice(users), text=f'Бенчмарк {i}', reminder_time=now,
+                pre_reminder_time=now - datetime.timedelta(minutes=15), repeat_type=randomizer.choice([None, 'daily', 'weekly']),
+            )
+            item.next_fire_at = now
+            items.append(item)
+        due = DueItems([], reminders, [], tasks, [])
+        legacy_ms = measure(lambda: [legacy_render(item, 'reminder') for item in reminders] + [legacy_render(item, 'task') for item in tasks], repeat)
+        template_ms = measure(lambda: [render_message('reminder', item) for item in reminders] + [(render_message('task', item), task_markup(item.id)) for item in tasks], repeat)
+        # Полный этап вместе с созданием строк Outbox
+        render_due_ms = measure(lambda: render_due(due), repeat)
+        results.append({
+            'scenario': 'render',
+            'size': size,
+            'ms': round(template_ms, 3),
+            'legacy_ms': round(legacy_ms, 3),
+            'us_per_item': round(template_ms * 1000 / size, 3),
+            'render_due_ms': round(render_due_ms, 3),
+        })
+    return results
+
+
+class RecordingBot:
+    '''
+        Бот, который ничего не отправляет: любой метод только считает вызовы
+    '''
+
+    def __init__(self):
+        self.calls = 0
+
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            self.calls += 1
+        return method
+
+
+@contextlib.contextmanager
+def isolated():
+    '''
+        Каждый размер работает на своих данных: всё созданное откатывается до точки сохранения.
+        Отладочный вывод обработчиков (print) подавляется
+    '''
+    savepoint = transaction.savepoint()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        transaction.savepoint_rollback(savepoint)
+
+
+def peak_moment() -> datetime.datetime:
+    '''
+        Утренний пик: ровно в 08:00 срабатывает больше всего напоминаний
+    '''
+    return timezone.localtime().replace(hour=8, minute=0, second=30, microsecond=0)
+
+
+def bench_send(sizes: list[int], repeat: int = 1) -> list[dict]:
+    '''
+        Проход рассылки (постановка в Outbox и разбор очереди) в утренний пик на таблице из size строк
+    '''
+    now = peak_moment()
+    results = []
+    for size in sizes:
+        with isolated():
+            create_population(size, now, seed=size)
+            pool = DeliveryPool(SlowBot(0), global_rate=10 ** 6, chat_rate=10 ** 6)
+            timer = QueryTimer()
+            started = time.perf_counter()
+            with connection.execute_wrapper(timer):
+                enqueued = enqueue_due(now=now)
+                counters = drain_outbox(pool, now=now)
+            elapsed = time.perf_counter() - started
+            pool.close()
+        results.append({
+            'scenario': 'send',
+            'size': size,
+            'ms': round(elapsed * 1000, 3),
+            'enqueued': enqueued,
+            'sent': counters['sent'],
+            'api_calls': pool.stats.snapshot()['sent'],
+            'db_ms': round(timer.seconds * 1000, 3),
+            'queries': timer.queries,
+        })
+    return results
+
+
+def bench_clear(sizes: list[int], repeat: int = 1) -> list[dict]:
+    '''
+        Очистка завершённых элементов (с переносом в архив) без ограничения по времени
+    '''
+    now = timezone.now()
+    results = []
+    for size in sizes:
+        with isolated():
+            create_population(size, now, seed=size)
+            report = purge_finished(now=now, budget=10 ** 6, pause=0)['total']
+        results.append({
+            'scenario': 'clear',
+            'size': size,
+            'ms': report['elapsed_s'] * 1000,
+            'rows': report['rows'],
+            'rows_per_s': report['rows_per_s'],
+            'max_lock_ms': report['max_lock_ms'],
+        })
+    return results
+
+
+def bench_list(sizes: list[int], repeat: int = 5) -> list[dict]:
+    '''
+        Список напоминаний самого активного пользователя при таблице из size строк
+    '''
+    from ..handlers.reminder import list_reminders
+
+    now = timezone.now()
+    results = []
+    for size in sizes:
+        with isolated():
+            create_population(size, now, seed=size)
+            busiest = Reminder.objects.values('user_id').annotate(items=Count('id')).order_by('-items').first()
+            user_id = busiest['user_id']
+            items = Reminder.objects.filter(user_id=user_id).count() + Task.objects.filter(user_id=user_id).count()
+            message = SimpleNamespace(from_user=SimpleNamespace(id=user_id), chat=SimpleNamespace(id=user_id))
+            ms = measure(lambda: list_reminders(message, RecordingBot()), repeat)
+        results.append({'scenario': 'list', 'size': size, 'ms': round(ms, 3), 'items': items})
+    return results
+
+
+PHRASES = ('завтра в 10:00', 'через 2 часа', 'каждый день в 22:00', 'в понедельник в 15:30', 'в пятницу в 18:00', 'через 30 минут')
+
+
+def bench_parse_create(sizes: list[int], repeat: int = 1) -> list[dict]:
+    '''
+        Разбор времени и создание напоминания (как после ответа ИИ), size - количество фраз
+    '''
+    from ..handlers.reminder import create_reminder_from_ai
+
+    results = []
+    for size in sizes:
+        with isolated():
+            user_id = create_users(1)[0]
+            user = UserProfile.objects.get(user_id=user_id)
+            message = SimpleNamespace(from_user=SimpleNamespace(id=user_id), chat=SimpleNamespace(id=user_id), text='')
+            bot = RecordingBot()
+            phrases = [PHRASES[i % len(PHRASES)] for i in range(size)]
+
+            parse_ms = measure(lambda: [parse_reminder_time(phrase, user=user) for phrase in phrases], 1)
+            started = time.perf_counter()
+            for i, phrase in enumerate(phrases):
+                create_reminder_from_ai(message, {'type': 'reminder', 'reminder_text': f'Бенчмарк {i}', 'time_text': phrase}, bot)
+            elapsed = time.perf_counter() - started
+            created = Reminder.objects.filter(user_id=user_id).count()
+        results.append({
+            'scenario': 'parse_create',
+            'size': size,
+            'ms': round(elapsed * 1000, 3),
+            'parse_ms': round(parse_ms, 3),
+            'created': created,
+            'per_s': round(size / elapsed, 1),
+        })
+    return results
+
+
+# Смесь входящих обновлений: вид, доля и время обработки в секундах.
+# Времена LLM (текст) и распознавания (голос) уменьшены примерно в 16 раз, соотношение сохранено
+UPDATE_MIX = (
+    ('callback', 0.5, 0.005),
+    ('text', 0.4, 0.12),
+    ('voice', 0.1, 0.5),
+)
+
+
+def bench_updates(sizes: list[int], repeat: int = 1, updates: int = 200, chats: int = 50, rate: float = 20) -> list[dict]:
+    '''
+        Задержка обработки входящих обновлений по числу потоков пула (sizes - числа потоков).
+        Обновления приходят с постоянной частотой rate в секунду, вид выбирается по UPDATE_MIX.
+        Задержка - от постановки в очередь до конца обработчика; отдельно считается, не нарушен ли порядок внутри чата
+    '''
+    results = []
+    rng = random.Random(0)
+    kinds = rng.choices([kind for kind, _, _ in UPDATE_MIX], weights=[share for _, share, _ in UPDATE_MIX], k=updates)
+    durations = {kind: duration for kind, _, duration in UPDATE_MIX}
+    stream = [
+        SimpleNamespace(update_id=i, kind=kind, message=SimpleNamespace(chat=SimpleNamespace(id=rng.randrange(chats))))
+        for i, kind in enumerate(kinds)
+    ]
+
+    for workers in sizes:
+        latencies = {kind: [] for kind in durations}
+        handled = {}
+        lock = threading.Lock()
+
+        def handle(update):
+            time.sleep(durations[update.kind])
+            with lock:
+                latencies[update.kind].append(time.perf_counter() - update.submitted_at)
+                handled.setdefault(update.message.chat.id, []).append(update.update_id)
+
+        executor = UpdateExecutor(handle, workers=workers, queue_size=updates * workers)
+        started = time.perf_counter()
+        for i, update in enumerate(stream):
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            update.submitted_at = time.perf_counter()
+            executor.submit(update)
+        executor.join()
+        elapsed = time.perf_counter() - started
+        executor.close()
+
+        everything = sorted(value for values in latencies.values() for value in values)
+        result = {
+            'scenario': 'updates',
+            'size': workers,
+            'ms': round(elapsed * 1000, 3),
+            'p50_ms': round(percentile(everything, 0.5) * 1000, 3),
+            'p99_ms': round(percentile(everything, 0.99) * 1000, 3),
+            'out_of_order': sum(ids != sorted(ids) for ids in handled.values()),
+        }
+        for kind, values in latencies.items():
+            values.sort()
+            result[f'{kind}_p50_ms'] = round(percentile(values, 0.5) * 1000, 3)
+            result[f'{kind}_p99_ms'] = round(percentile(values, 0.99) * 1000, 3)
+        results.append(result)
+    return results
+
+
+# Сценарии с несколькими потоками не могут работать внутри одной откатываемой транзакции
+bench_workers.atomic = False
+bench_updates.atomic = False
+
+# Размеры по умолчанию, если --sizes не указан. Для workers и updates размер - число потоков, а не строк
+DEFAULT_SIZES = [1000, 10000, 100000]
+bench_workers.default_sizes = [1, 2, 4, 8]
+bench_updates.default_sizes = [1, 8, 32]
+
+
+SCENARIOS = {
+    'due': bench_due,
+    'delivery': bench_delivery,
+    'workers': bench_workers,
+    'render': bench_render,
+    'send': bench_send,
+    'clear': bench_clear,
+    'list': bench_list,
+    'parse_create': bench_parse_create,
+    'updates': bench_updates,
+}
@@ -1,13 +1,17 @@
 import datetime
 import logging
 
-from django.db.models import Q
 from django.utils import timezone
-from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
+from telebot.types import CallbackQuery
 from telebot import TeleBot
 
 from bot import bot
-from ..models import Reminder, Task
+from ..models import Task
+from ..services.delivery import get_delivery_pool
+from ..services.metrics import TickMetrics
+from ..services.outbox import drain_outbox, enqueue_due
+from ..services.recurrence import rearm
+from ..services.retention import purge_finished
 
 # Создание логгеров для отправки и удаления
 send_logger = logging.getLogger('send_log')
@@ -19,137 +23,62 @@ delete_handler = logging.getLogger('delete_log.log')
 delete_logger.addHandler(send_handler)
 
 
-def send_reminders():
+def send_reminders(deliver: bool = True):
     '''
-        Функция отправки всех напоминаний, включая задачи
+        Функция отправки всех напоминаний, включая задачи.
+        Сначала готовые элементы ставятся в очередь Outbox, затем очередь разбирается.
+        Метрики прохода сохраняются в DispatchTick
     '''
 
-    pre_reminders = Reminder.objects.filter(reminder_time__lte=timezone.now() - datetime.timedelta(minutes=15), is_pre_reminder_sent=False) | \
-                    Reminder.objects.filter(~Q(repeat_type=None), ~Q(repeat_time=None), repeat_time__lte=timezone.now() - datetime.timedelta(minutes=15), is_pre_reminder_sent=False)
-    
-    pre_tasks = Task.objects.filter(reminder_time__lte=timezone.now() - datetime.timedelta(minutes=15), is_pre_reminder_sent=False) | \
-                Task.objects.filter(~Q(repeat_type=None), ~Q(repeat_time=None), repeat_time__lte=timezone.now() - datetime.timedelta(minutes=15), is_pre_reminder_sent=False)
-    
-    reminders = Reminder.objects.filter(reminder_time__lte=timezone.now(), is_main_reminder_sent=False) | \
-                Reminder.objects.filter(~Q(repeat_type=None), ~Q(repeat_time=None), repeat_time__lte=timezone.now(), is_main_reminder_sent=False)
-    
-    tasks = Task.objects.filter(reminder_time__lte=timezone.now(), is_completed=False) | \
-            Task.objects.filter(~Q(repeat_type=None), ~Q(repeat_time=None), repeat_time__lte=timezone.now(), is_main_reminder_sent=False, is_completed=False) | \
-            Task.objects.filter(transfer_time__lte=timezone.now(), is_transfered=True, is_completed=False)
-    
     send_logger.debug(f'{"=" * 5}ОТПРАВКА НАПОМИНАНИЙ {datetime.datetime.now()}{"=" * 5}')
+    metrics = TickMetrics()
 
     try:
-        for pre_reminder in pre_reminders:
-            repeat_info = ""
-            if not pre_reminder.repeat_type is None:
-                if pre_reminder.repeat_type == 'daily':
-                    repeat_info = " 🔄"
-                elif pre_reminder.repeat_type == 'weekly':
-                    repeat_info = " 🔄"
-
-            bot.send_message(
-                chat_id=pre_reminder.user.user_id,
-                text=f"⏰ Предварительное напоминание (через 15 минут)!{repeat_info}\n"
-                f"📝 {pre_reminder.text}"
-            )
-
-            pre_reminder.is_pre_reminder_sent = True
-            pre_reminder.save()
-        
-        send_logger.debug(f'Отправлено {pre_reminders.count()} предварительных напоминаний')
-
-        for reminder in reminders:
-            repeat_info = ""
-            if not reminder.repeat_type is None:
-                if reminder.repeat_type == 'daily':
-                    repeat_info = " 🔄 (повторится завтра)"
-                elif reminder.repeat_type == 'weekly':
-                    repeat_info = " 🔄 (повторится через неделю)"
-            
-            bot.send_message(
-                chat_id=reminder.user.user_id,
-                text=f"🔔 Время пришло!{repeat_info}\n"
-                f"📝 {reminder.text}"
-            )
-
-            reminder.is_main_reminder_sent = True
-            reminder.save()
-
-        send_logger.debug(f'Отправлено {reminders.count()} напоминаний')
-
-        for task in pre_tasks:
-            repeat_info = ""
-            if not task.repeat_type is None:
-                if task.repeat_type == 'daily':
-                    repeat_info = " 🔄 (повторится завтра)"
-                elif task.repeat_type == 'weekly':
-                    repeat_info = " 🔄 (повторится через неделю)"
-
-            bot.send_message(
-                chat_id=task.user.user_id,
-                text=f"⏰ Предварительное напоминание для задачи (через 15 минут)!{repeat_info}\n"
-                f"📝 {task.text}"
-            )
-            task.is_pre_reminder_sent = True
-            task.save()
-
-        send_logger.debug(f'Отправлено {pre_tasks.count()} предварительных напоминаний для задач')
-    
-        for task in tasks:
-            markup = InlineKeyboardMarkup()
-            markup.add(InlineKeyboardButton(text="✅ Завершить!", callback_data=f"t.finish|{task.id}"))
-            markup.add(InlineKeyboardButton(text="⏳ Отложить", callback_data=f"t.put_off|{task.id}"))
-            markup.add(InlineKeyboardButton(text="❌ Удалить", callback_data=f"t.remove|{task.id}"))
-            
-            repeat_info = ""
-            if not task.repeat_type is None:
-                if task.repeat_type == 'daily':
-                    repeat_info = " 🔄 (повторится завтра)"
-                elif task.repeat_type == 'weekly':
-                    repeat_info = " 🔄 (повторится через неделю)"
-
-            bot.send_message(
-                chat_id=task.user.user_id,
-                text=f"🔔 Время пришло!{repeat_info}\n"
-                f"📝 {task.text}",
-                reply_markup=markup
-            )
-
-            task.is_main_reminder_sent = True
-            task.save()
+        enqueued = enqueue_due(metrics=metrics)
+        send_logger.debug(f'В очередь поставлено {enqueued} сообщений')
+    except Exception as e:
+        send_logger.error(e)
 
-        send_logger.debug(f'Отправлено {tasks.count} напоминаний для задач')
-        
+    if deliver:
+        try:
+            pool = get_delivery_pool(bot)
+            counters = drain_outbox(pool, metrics=metrics)
+            send_logger.debug(f'Отправлено {counters["sent"]} сообщений, ошибок: {counters["failed"]}')
+            send_logger.debug(f'Статистика отправки: {pool.stats.snapshot()}')
+        except Exception as e:
+            send_logger.error(e)
 
+    try:
+        tick = metrics.save()
+        send_logger.debug(f'Выборка {tick.scan_ms} мс, опоздание p50 {tick.lateness_p50_s} с, p99 {tick.lateness_p99_s} с')
     except Exception as e:
         send_logger.error(e)
-    
+
     send_logger.debug(f'{"=" * 5}ОТПРАВКА ЗАВЕРШЕНА{"=" * 5}')
     
 
 def clear_reminders():
     '''
-        Удаление устаревших напоминаний и выполненных задач
+        Удаление завершённых напоминаний и выполненных задач порциями в пределах бюджета времени
     '''
     
-    delete_logger.debug(f'{"=" * 5}УДАЛЕНИЕ УСТАРЕВШИХ НАПОМИНАНИЙ {datetime.datetime.now()}{"=" * 5}')
+    delete_logger.debug(f'{"=" * 5}УДАЛЕНИЕ УСТАРЕВШИХ НАПОМИНАНИЙ {timezone.now()}{"=" * 5}')
 
     try:
-        reminder_delete = Reminder.objects.filter(reminder_time__lte=datetime.datetime.now())
-        task_delete = Task.objects.filter(is_completed=True)
-        count = reminder_delete.count() + task_delete.count()
-
-        reminder_delete.delete()
-        task_delete.delete()
-
-        delete_logger.debug(f'Удалено {count} объектов')
+        report = purge_finished()
+        total = report['total']
+        delete_logger.debug(
+            f'Удалено {total["rows"]} объектов за {total["elapsed_s"]} с ({total["rows_per_s"]} строк/с), '
+            f'блокировка записи {total["lock_s"]} с, максимум {total["max_lock_ms"]} мс'
+        )
+        if not total['done']:
+            delete_logger.debug('Бюджет времени исчерпан, остаток будет удалён при следующем запуске')
 
     except Exception as e:
         with open('delete_log.txt', 'a', encoding='utf-8') as f:
-            f.write('\n\n' + e)
+            f.write('\n\n' + str(e))
 
-    delete_logger.debug(f'{"=" * 5}УДАЛЕНИЕ ЗАВЕРШЕНО {datetime.datetime.now()}{"=" * 5}')
+    delete_logger.debug(f'{"=" * 5}УДАЛЕНИЕ ЗАВЕРШЕНО {timezone.now()}{"=" * 5}')
 
 
 def task_sets(call: CallbackQuery, bot: TeleBot):
@@ -165,13 +94,29 @@ def task_sets(call: CallbackQuery, bot: TeleBot):
 
     if task_data[0] == 'finish':
         try: 
-            task.is_completed = True
-            task.save()
-            bot.send_message(
-                text='Отлично!'
-                f'\nЗадача "{task.text}" завершена! ✅',
-                chat_id=call.message.chat.id
-                )
+            if task.repeat_type:
+                # Повторяющаяся задача: отмечается только текущее повторение, следующие остаются
+                if task.is_pre_reminder_sent and not task.is_main_reminder_sent:
+                    rearm(task, timezone.now())
+                task.is_transfered = False
+                task.transfer_time = None
+                task.save()
+                offset = datetime.timedelta(hours=int(task.user.timezone[1:]))
+                custom_tz = timezone.get_fixed_timezone(offset)
+                bot.send_message(
+                    text='Отлично!'
+                    f'\nЗадача "{task.text}" выполнена! ✅'
+                    f'\nСледующее напоминание будет в {task.reminder_time.astimezone(custom_tz)}',
+                    chat_id=call.message.chat.id
+                    )
+            else:
+                task.is_completed = True
+                task.save()
+                bot.send_message(
+                    text='Отлично!'
+                    f'\nЗадача "{task.text}" завершена! ✅',
+                    chat_id=call.message.chat.id
+                    )
         except Exception as e:
             bot.send_message(
                 text='Возникла ошибка, приносим свои извинения и уже работаем над исправлением',
@@ -183,7 +128,8 @@ def task_sets(call: CallbackQuery, bot: TeleBot):
         try:
             offset = datetime.timedelta(hours=int(task.user.timezone[1:]))
             custom_tz = timezone.get_fixed_timezone(offset)
-            transfer_time = task.reminder_time.astimezone(custom_tz) + datetime.timedelta(minutes=30)
+            # От текущего момента: у повторяющейся задачи reminder_time уже переведён на следующее повторение
+            transfer_time = timezone.now().astimezone(custom_tz) + datetime.timedelta(minutes=30)
             task.is_transfered = True
             task.transfer_time = transfer_time
             task.save()
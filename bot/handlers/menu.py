@@ -19,6 +19,8 @@ def cmd_start(message: Message, bot: TeleBot):
     """
         Обработчик команды /start
     """
+    # Пользователь снова пишет боту - значит, разблокировал его
+    UserProfile.objects.filter(user_id=message.from_user.id, is_blocked=True).update(is_blocked=False)
     bot.set_state(message.from_user.id, SettingsStates.addressing, message.chat.id)
     return bot.send_message(
         chat_id=message.chat.id,
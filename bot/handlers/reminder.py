@@ -68,6 +68,10 @@ def list_reminders(message: Message, bot: TeleBot):
         )
         return
     
+    # Часовой пояс один на весь список, профиль читаем один раз
+    user = UserProfile.objects.get(user_id=message.from_user.id)
+    custom_tz = timezone.get_fixed_timezone(timedelta(hours=int(user.timezone[1:])))
+
     # Группируем напоминания по типу
     one_time_reminders = reminders.filter(repeat_type=None)
     recurring_reminders = reminders.exclude(repeat_type=None)
@@ -83,8 +87,6 @@ def list_reminders(message: Message, bot: TeleBot):
         message_parts.append("📅 **Разовые напоминания:**")
         for i, reminder in enumerate(one_time_reminders, 1):
             # Убираем информацию о часовом поясе
-            offset = timedelta(hours=int(reminder.user.timezone[1:]))
-            custom_tz = timezone.get_fixed_timezone(offset)
             reminder_time = reminder.reminder_time.astimezone(custom_tz)
             current_time = datetime.now(custom_tz)
             
@@ -115,7 +117,7 @@ def list_reminders(message: Message, bot: TeleBot):
         
         message_parts.append("🔄 **Повторяющиеся напоминания:**")
         for reminder in recurring_reminders:
-            reminder_time = datetime.fromisoformat(reminder.reminder_time)
+            reminder_time = reminder.reminder_time.astimezone(custom_tz)
             
             if reminder.repeat_type == 'daily':
                 repeat_text = "каждый день"
@@ -141,8 +143,6 @@ def list_reminders(message: Message, bot: TeleBot):
         message_parts.append("📅 **Разовые задачи:**")
         for i, task in enumerate(one_time_tasks, 1):
             # Убираем информацию о часовом поясе
-            offset = timedelta(hours=int(task.user.timezone[1:]))
-            custom_tz = timezone.get_fixed_timezone(offset)
             task_time = task.reminder_time.astimezone(custom_tz)
             current_time = datetime.now(custom_tz)
             
@@ -174,7 +174,7 @@ def list_reminders(message: Message, bot: TeleBot):
         
         message_parts.append("🔄 **Повторяющиеся напоминания:**")
         for task in recurring_tasks:
-            task_time = datetime.fromisoformat(task.reminder_time)
+            task_time = task.reminder_time.astimezone(custom_tz)
             
             if task.repeat_type == 'daily':
                 repeat_text = "каждый день"
@@ -196,11 +196,15 @@ def list_reminders(message: Message, bot: TeleBot):
             )
 
     # Добавляем информационное сообщение
+    if user.pre_reminder_minutes:
+        lead_info = f"• Вы получите уведомление за {user.pre_reminder_minutes} мин до события\n"
+    else:
+        lead_info = "• Предварительные уведомления отключены\n"
     message_parts.append(
         "\n💡 **Информация:**\n"
         "• Разовые напоминания и задачи удаляются автоматически после выполнения\n"
         "• Повторяющиеся напоминания и задачи работают по расписанию\n"
-        "• Вы получите уведомление за 15 минут до события"
+        f"{lead_info}"
         "• При переносе, задача будет отложена на полчаса"
     )
     
@@ -638,9 +642,8 @@ def handle_delete_reminder_from_ai(message: Message, ai_data: dict, bot: TeleBot
                 f"Найдено {len(matching_reminders)} напоминаний {search_type} '{search_text}':\n"
             ]
             
+            custom_timezone = timezone.get_fixed_timezone(offset=timedelta(hours=custom_delta))
             for i, reminder in enumerate(matching_reminders, 1):
-                offset = timedelta(hours=int(reminder.user.timezone[1:]))
-                custom_timezone = timezone.get_fixed_timezone(offset=offset)
                 reminder_time = reminder.reminder_time.astimezone(custom_timezone)
                 repeat_info = ""
                 if reminder.repeat_type:
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bot.models import Reminder, Task
+
+
+class Command(BaseCommand):
+    help = 'Заполняет next_fire_at и next_fire_kind у существующих напоминаний и задач порциями по ID'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk', type=int, default=1000, help='Строк в одной транзакции')
+        parser.add_argument('--pause', type=float, default=0.05, help='Пауза между порциями, секунды')
+
+    def handle(self, *args, **options):
+        for model in (Reminder, Task):
+            last_id = 0
+            total = 0
+            while True:
+                items = list(model.objects.filter(id__gt=last_id).order_by('id')[:options['chunk']])
+                if not items:
+                    break
+                for item in items:
+                    item.update_next_fire()
+                with transaction.atomic():
+                    model.objects.bulk_update(items, ['next_fire_at', 'next_fire_kind'])
+                last_id = items[-1].id
+                total += len(items)
+                # Короткие транзакции с паузами не держат блокировку записи SQLite подолгу
+                time.sleep(options['pause'])
+            self.stdout.write(f'{model._meta.verbose_name_plural}: обновлено {total}')
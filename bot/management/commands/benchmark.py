@@ -0,0 +1,66 @@
+import datetime
+import json
+import platform
+import subprocess
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from bot.benchmarks.scenarios import DEFAULT_SIZES, SCENARIOS
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Запускает нагрузочный сценарий на синтетических данных. Все созданные строки откатываются или удаляются'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(SCENARIOS))
+        parser.add_argument('--sizes', type=int, nargs='+', help='По умолчанию - свои для каждого сценария')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--json', action='store_true', help='Вывести результаты одним JSON-документом для сравнения между коммитами')
+
+    def handle(self, *args, **options):
+        scenario = SCENARIOS[options['scenario']]
+        sizes = options['sizes'] or getattr(scenario, 'default_sizes', DEFAULT_SIZES)
+        if not getattr(scenario, 'atomic', True):
+            results = scenario(sizes=sizes, repeat=options['repeat'])
+            self.print_results(results, options)
+            return
+
+        try:
+            with transaction.atomic():
+                results = scenario(sizes=sizes, repeat=options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+        self.print_results(results, options)
+
+    def commit(self) -> str:
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def print_results(self, results, options):
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'meta': {
+                    'scenario': options['scenario'],
+                    'commit': self.commit(),
+                    'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'database': connection.vendor,
+                    'repeat': options['repeat'],
+                },
+                'results': results,
+            }, ensure_ascii=False, default=str))
+            return
+        for result in results:
+            extra = ' '.join(f'{key}={value}' for key, value in result.items() if key not in ('scenario', 'size', 'ms'))
+            self.stdout.write(f"{result['scenario']:<10} size={result['size']:<10} {result['ms']:>10.3f} ms  {extra}")
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from bot import bot
+from bot.services.identity import setup_bot
+
+
+class Command(BaseCommand):
+    help = 'Регистрирует команды бота в Telegram и обновляет кэш getMe (запускается при развёртывании)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--webhook', action='store_true', help='Заодно установить вебхук на HOOK')
+
+    def handle(self, *args, **options):
+        me = setup_bot(bot)
+        self.stdout.write(f"@{me['username']} (id {me['id']}): команды зарегистрированы, кэш {settings.BOT_IDENTITY_CACHE} обновлён")
+        if options['webhook']:
+            bot.set_webhook(url=f"{settings.HOOK}/bot/{settings.BOT_TOKEN}", allowed_updates=['message', 'callback_query'])
+            self.stdout.write(f'Вебхук установлен на {settings.HOOK}')
@@ -0,0 +1,53 @@
+import datetime
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from bot.models import DispatchTick
+from bot.services.metrics import percentile
+
+
+class Command(BaseCommand):
+    help = 'Показывает метрики проходов рассылки: время выборки, задержку отправки и гистограмму опоздания'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=60, help='За какой период показывать, минуты')
+        parser.add_argument('--ticks', type=int, default=10, help='Сколько последних проходов вывести построчно')
+        parser.add_argument('--slo', type=float, default=60, help='Цель по опозданию, секунды')
+
+    def handle(self, *args, **options):
+        since = timezone.now() - datetime.timedelta(minutes=options['minutes'])
+        ticks = list(DispatchTick.objects.filter(started_at__gte=since).order_by('started_at'))
+        if not ticks:
+            self.stdout.write('Нет данных за выбранный период')
+            return
+
+        self.stdout.write(f'{"Начало":<20} {"Выборка мс":>10} {"Готово":>7} {"Отпр.":>6} {"Ош.":>5} {"p50 мс":>8} {"p99 мс":>8} {"Опозд. p99 с":>13}')
+        for tick in ticks[-options['ticks']:]:
+            self.stdout.write(
+                f'{timezone.localtime(tick.started_at):%Y-%m-%d %H:%M:%S} {tick.scan_ms:>10} {sum(tick.due.values()):>7} '
+                f'{tick.sent:>6} {tick.failed:>5} {tick.latency_p50_ms:>8} {tick.latency_p99_ms:>8} {tick.lateness_p99_s:>13}'
+            )
+
+        due = Counter()
+        histogram = Counter()
+        for tick in ticks:
+            due.update(tick.due)
+            histogram.update(tick.lateness_histogram)
+        scans = sorted(tick.scan_ms for tick in ticks)
+        sent = sum(tick.sent for tick in ticks)
+
+        self.stdout.write(f'\nПроходов: {len(ticks)}, отправлено: {sent}, ошибок: {sum(tick.failed for tick in ticks)}')
+        self.stdout.write(f'Готово по видам: {dict(due)}')
+        self.stdout.write(f'Выборка: p50 {percentile(scans, 0.5)} мс, максимум {scans[-1]} мс')
+        self.stdout.write('Опоздание отправки:')
+        for bound in [str(bound) for bound in settings.LATENESS_BUCKETS] + ['+Inf']:
+            count = histogram.get(bound, 0)
+            share = count / sent * 100 if sent else 0
+            self.stdout.write(f'  <= {bound:>5} с: {count:>7} ({share:.1f}%) {"#" * round(share / 2)}')
+
+        within = sum(histogram.get(str(bound), 0) for bound in settings.LATENESS_BUCKETS if bound <= options['slo'])
+        if sent:
+            self.stdout.write(f'В пределах {options["slo"]} с: {within / sent * 100:.2f}%')
@@ -0,0 +1,45 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from bot import bot
+from bot.services.delivery import get_delivery_pool
+from bot.services.metrics import TickMetrics
+from bot.services.outbox import drain_outbox
+
+
+class Command(BaseCommand):
+    help = 'Разбирает очередь исходящих сообщений (Outbox). Можно запускать независимо от планировщика'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Разобрать очередь один раз и выйти')
+        parser.add_argument('--processes', type=int, help='Сколько процессов отправляют одновременно, '
+                            'лимит бота делится между ними (по умолчанию DELIVERY_PROCESSES)')
+
+    def handle(self, *args, **options):
+        pool = get_delivery_pool(bot, processes=options['processes'])
+        if options['once']:
+            metrics = TickMetrics()
+            counters = drain_outbox(pool, metrics=metrics)
+            metrics.save()
+            self.stdout.write(f"Отправлено {counters['sent']}, ошибок {counters['failed']}")
+            return
+
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+        signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+        while not stop_event.is_set():
+            close_old_connections()
+            metrics = TickMetrics()
+            try:
+                counters = drain_outbox(pool, metrics=metrics)
+                if counters['sent'] or counters['failed']:
+                    metrics.save()
+            except Exception as e:
+                self.stderr.write(f'Ошибка разбора очереди: {e}')
+                counters = {'sent': 0}
+            if not counters['sent']:
+                stop_event.wait(settings.OUTBOX_POLL_INTERVAL)
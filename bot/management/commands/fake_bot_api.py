@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from bot.benchmarks.fake_api import FakeBotAPI, make_server
+
+
+class Command(BaseCommand):
+    help = 'Запускает локальную имитацию Bot API для нагрузочных прогонов (бот подключается через BOT_API_URL)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8081)
+        parser.add_argument('--latency', type=float, default=0.05, help='Задержка ответа, секунды')
+        parser.add_argument('--jitter', type=float, default=0.0, help='Случайная добавка к задержке, секунды')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Доля запросов отправки, получающих 429')
+        parser.add_argument('--chat-rate', type=float, default=None, help='Лимит сообщений в секунду на чат')
+        parser.add_argument('--global-rate', type=float, default=None, help='Лимит сообщений в секунду на бота')
+        parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответах 429, секунды')
+        parser.add_argument('--updates', type=int, default=0, help='Сколько входящих сообщений отдать через getUpdates')
+        parser.add_argument('--chats', type=int, default=100, help='Между сколькими чатами распределить входящие сообщения')
+
+    def handle(self, *args, **options):
+        api = FakeBotAPI(
+            latency=options['latency'],
+            jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            chat_rate=options['chat_rate'],
+            global_rate=options['global_rate'],
+            retry_after=options['retry_after'],
+        )
+        for i in range(options['updates']):
+            api.push_update(chat_id=i % options['chats'] + 1, text='📋 Все напоминания и задачи')
+        server = make_server(api, options['host'], options['port'])
+        self.stdout.write(f"Bot API слушает http://{options['host']}:{options['port']} (статистика - /stats)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f'Итого: {api.stats()}')
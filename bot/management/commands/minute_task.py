@@ -1,16 +1,43 @@
+import argparse
+import datetime
 import logging
+import os
+
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
 from django.utils import timezone
 
 from bot.handlers.common import send_reminders, clear_reminders
+from bot.services.dryrun import copy_sqlite_database, replay
 
 logger = logging.getLogger(__name__)
 
 
+class Rollback(Exception):
+    pass
+
+
+def parse_timestamp(value: str) -> datetime.datetime:
+    try:
+        moment = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Некорректное время: {value}')
+    return moment if timezone.is_aware(moment) else timezone.make_aware(moment)
+
+
 class Command(BaseCommand):
     help = 'Отправляет ежедневные отчеты всем пользователям и сбрасывает дневные расходы'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Прогнать рассылку по фиктивным часам без отправки и без изменений в базе')
+        parser.add_argument('--now', type=parse_timestamp, help='Начало прогона, например 2025-09-01T07:30')
+        parser.add_argument('--until', type=parse_timestamp, help='Конец прогона (по умолчанию начало + 1 час)')
+        parser.add_argument('--step', type=int, default=60, help='Шаг фиктивных часов, секунды')
+
     def handle(self, *args, **kwargs):
+        if kwargs['dry_run']:
+            return self.dry_run(kwargs['now'] or timezone.now(), kwargs['until'], kwargs['step'])
+
         with open('checking_log.txt', 'a', encoding='utf-8') as f:
             f.write('\n' + '=' * 10 + 'Начало' + '=' * 10)
         try:
@@ -33,4 +60,38 @@ class Command(BaseCommand):
                 f.write(f'\n❌Ошибка при чистке: {e}')
 
         with open('checking_log.txt', 'a', encoding='utf-8') as f:
-            f.write('\nКонец\n' + '=' * 30)
\ No newline at end of file
+            f.write('\nКонец\n' + '=' * 30)
+
+    def dry_run(self, start: datetime.datetime, until: datetime.datetime, step: int):
+        '''
+            Прогон на копии базы (SQLite) внутри откатываемой транзакции: рабочая база не меняется и не блокируется
+        '''
+        until = until or start + datetime.timedelta(hours=1)
+        original = connection.settings_dict['NAME']
+        path = copy_sqlite_database()
+        try:
+            with transaction.atomic():
+                report = replay(start, until, step)
+                raise Rollback
+        except Rollback:
+            pass
+        finally:
+            if path:
+                connection.close()
+                connection.settings_dict['NAME'] = original
+                os.remove(path)
+
+        for row in report['steps']:
+            if row['messages']:
+                self.stdout.write(
+                    f"{timezone.localtime(row['at']):%Y-%m-%d %H:%M:%S} сообщений {row['messages']:>6} "
+                    f"(элементов {row['items']:>6}, макс. в чат {row['max_per_chat']:>3}) база {row['db_ms']:>9.3f} мс"
+                )
+        peak_at = f"{timezone.localtime(report['peak_at']):%H:%M:%S}" if report['peak_at'] else '-'
+        self.stdout.write(
+            f"\nДо начала прогона отправлено без учёта: {report['skipped']} элементов\n"
+            f"Всего сообщений: {report['messages']} (элементов {report['items']}), "
+            f"в среднем {report['messages_per_minute']} в минуту\n"
+            f"Пик: {report['peak_burst']} сообщений за шаг в {peak_at}, до {report['peak_per_chat']} в один чат\n"
+            f"Время базы: {report['db_ms']} мс всего, до {report['db_ms_max']} мс за шаг"
+        )
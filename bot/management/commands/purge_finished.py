@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from bot.services.retention import purge_finished
+
+
+class Command(BaseCommand):
+    help = 'Удаляет завершённые напоминания, выполненные задачи и старые сообщения очереди порциями'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk', type=int, default=None, help='Строк в одной транзакции')
+        parser.add_argument('--pause', type=float, default=None, help='Пауза между порциями, секунды')
+        parser.add_argument('--budget', type=float, default=None, help='Бюджет времени на запуск, секунды')
+
+    def handle(self, *args, **options):
+        report = purge_finished(budget=options['budget'], chunk=options['chunk'], pause=options['pause'])
+        for name, stats in report.items():
+            self.stdout.write(f'{name}: ' + ', '.join(f'{key}={value}' for key, value in stats.items()))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from bot.services.retention import rollover_history
+
+
+class Command(BaseCommand):
+    help = 'Переносит историю за завершённые месяцы в отдельные файлы (SQLite) или таблицы (PostgreSQL)'
+
+    def handle(self, *args, **options):
+        moved = rollover_history()
+        if not moved:
+            self.stdout.write('Переносить нечего')
+        for month, count in moved.items():
+            self.stdout.write(f'{month}: перенесено {count}')
@@ -0,0 +1,25 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from bot import bot
+from bot.services.identity import setup_bot
+from bot.services.polling import Poller
+from bot.views import process_update
+
+
+class Command(BaseCommand):
+    help = 'Получение обновлений через getUpdates (для установок, где вебхук HOOK недоступен снаружи)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='Потоков обработки (по умолчанию UPDATE_WORKERS)')
+        parser.add_argument('--timeout', type=int, help='Ожидание новых обновлений в одном запросе, секунды')
+
+    def handle(self, *args, **options):
+        # getUpdates не работает, пока у бота установлен вебхук
+        bot.remove_webhook()
+        setup_bot(bot)
+        poller = Poller(bot, process_update, workers=options['workers'], timeout=options['timeout'])
+        signal.signal(signal.SIGTERM, lambda *_: poller.stop())
+        signal.signal(signal.SIGINT, lambda *_: poller.stop())
+        poller.run()
@@ -0,0 +1,27 @@
+import functools
+import signal
+
+from django.core.management.base import BaseCommand
+
+from bot.handlers.common import send_reminders, clear_reminders
+from bot.services.scheduler import Scheduler
+
+
+class Command(BaseCommand):
+    help = 'Постоянно работающий планировщик рассылки напоминаний (замена minute_task из cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horizon', type=int, help='Окно загрузки срабатываний, секунды')
+        parser.add_argument('--reload', type=int, help='Период догрузки новых напоминаний, секунды')
+        parser.add_argument('--enqueue-only', action='store_true', help='Только ставить сообщения в Outbox, отправку ведёт drain_outbox')
+
+    def handle(self, *args, **options):
+        scheduler = Scheduler(
+            send=functools.partial(send_reminders, deliver=not options['enqueue_only']),
+            cleanup=clear_reminders,
+            horizon=options['horizon'],
+            reload_interval=options['reload'],
+        )
+        signal.signal(signal.SIGTERM, lambda *_: scheduler.stop())
+        signal.signal(signal.SIGINT, lambda *_: scheduler.stop())
+        scheduler.run()
@@ -1,7 +1,9 @@
+import datetime
 import os
 import pytz
 
 from django.db import models
+from django.utils import timezone
 from django.core.files.storage import FileSystemStorage
 
 from main.settings import BASE_DIR
@@ -9,6 +11,40 @@ from main.settings import BASE_DIR
 
 fs = FileSystemStorage(location=f"{BASE_DIR}/media")
 
+# Виды ближайшего срабатывания
+NEXT_FIRE_KINDS = {
+    'pre': 'Предварительное напоминание',
+    'main': 'Напоминание',
+    'transfer': 'Перенос',
+}
+
+
+def earliest_fire(candidates: list) -> tuple:
+    '''
+        Ближайшее из неотправленных срабатываний: (время, вид) или (None, None)
+    '''
+    candidates = [candidate for candidate in candidates if candidate[0] is not None]
+    if not candidates:
+        return None, None
+    return min(candidates, key=lambda candidate: candidate[0])
+
+
+def pre_fire(item) -> datetime.datetime:
+    '''
+        Время предварительного напоминания, если оно ещё нужно: до основного и пока основное не отправлено
+    '''
+    if item.is_pre_reminder_sent or item.is_main_reminder_sent or item.pre_reminder_time >= item.reminder_time:
+        return None
+    return item.pre_reminder_time
+
+
+def save_with_next_fire(instance, save, *args, **kwargs):
+    instance.update_next_fire()
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None:
+        kwargs['update_fields'] = set(update_fields) | {'next_fire_at', 'next_fire_kind'}
+    save(*args, **kwargs)
+
 class UserProfile(models.Model):
     '''
         Модель для хранения информации о пользователе
@@ -18,6 +54,8 @@ class UserProfile(models.Model):
     addressing = models.CharField(verbose_name='Обращение', choices={'ty': 'Ты', 'vy': 'Вы'})
     tone = models.CharField(verbose_name='Тон общения', choices={'business': 'Деловой', 'friendly': 'Дружелюбный', 'neutral': 'Нейтральный'})
     timezone = models.CharField(verbose_name='Часовой пояс', default='+3', help_text='Разница с UTC в формате "±0"')
+    pre_reminder_minutes = models.PositiveSmallIntegerField(verbose_name='Предупреждать заранее, минут', default=15, help_text='0 - без предварительного напоминания')
+    is_blocked = models.BooleanField(verbose_name='Заблокировал бота', default=False, help_text='Напоминания не отправляются, пока пользователь снова не нажмёт /start')
 
     def __str__(self):
         return f'Пользователь {self.username}'
@@ -25,6 +63,10 @@ class UserProfile(models.Model):
     class Meta:
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
+        # Заблокировавших бота мало, планировщик перечитывает их список при каждой догрузке
+        indexes = [
+            models.Index(fields=['user_id'], condition=models.Q(is_blocked=True), name='userprofile_blocked_idx'),
+        ]
 
 
 class Reminder(models.Model):
@@ -45,13 +87,31 @@ class Reminder(models.Model):
     created_at = models.DateTimeField(verbose_name='Создано')
     repeat_type = models.TextField(verbose_name='Повторение', choices=REPEAT_TYPES, null=True, blank=True)
     repeat_time = models.DateTimeField(verbose_name='Дата и время повторения', null=True, blank=True)
+    next_fire_at = models.DateTimeField(verbose_name='Ближайшее срабатывание', null=True, blank=True, editable=False)
+    next_fire_kind = models.CharField(verbose_name='Вид ближайшего срабатывания', max_length=10, choices=NEXT_FIRE_KINDS, null=True, blank=True, editable=False)
 
     def __str__(self):
         return f'Напоминание пользователя от {self.reminder_time} {self.user.username} {self.text}'
+
+    def update_next_fire(self):
+        '''
+            Пересчёт ближайшего срабатывания по времени и флагам
+        '''
+        self.next_fire_at, self.next_fire_kind = earliest_fire([
+            (pre_fire(self), 'pre'),
+            (None if self.is_main_reminder_sent else self.reminder_time, 'main'),
+        ])
+
+    def save(self, *args, **kwargs):
+        save_with_next_fire(self, super().save, *args, **kwargs)
     
     class Meta:
         verbose_name = 'Напоминание'
         verbose_name_plural = 'Напоминания'
+        # Вся проверка готовности к отправке - один диапазон по этому индексу
+        indexes = [
+            models.Index(fields=['next_fire_at'], condition=models.Q(next_fire_at__isnull=False), name='reminder_next_fire_idx'),
+        ]
 
 
 class Task(models.Model):
@@ -77,15 +137,157 @@ class Task(models.Model):
     created_at = models.DateTimeField(verbose_name='Создано')
     repeat_type = models.TextField(verbose_name='Повторение', choices=REPEAT_TYPES, null=True, blank=True)
     repeat_time = models.DateTimeField(verbose_name='Дата и время повторения', null=True, blank=True)
+    next_fire_at = models.DateTimeField(verbose_name='Ближайшее срабатывание', null=True, blank=True, editable=False)
+    next_fire_kind = models.CharField(verbose_name='Вид ближайшего срабатывания', max_length=10, choices=NEXT_FIRE_KINDS, null=True, blank=True, editable=False)
 
     def __str__(self):
         return f'Задача пользователя {self.user_id}'
+
+    def update_next_fire(self):
+        '''
+            Пересчёт ближайшего срабатывания по времени и флагам
+        '''
+        if self.is_completed:
+            self.next_fire_at, self.next_fire_kind = None, None
+            return
+        self.next_fire_at, self.next_fire_kind = earliest_fire([
+            (pre_fire(self), 'pre'),
+            (None if self.is_main_reminder_sent else self.reminder_time, 'main'),
+            (self.transfer_time if self.is_transfered else None, 'transfer'),
+        ])
+
+    def save(self, *args, **kwargs):
+        save_with_next_fire(self, super().save, *args, **kwargs)
     
     class Meta:
         verbose_name = 'Задача'
         verbose_name_plural = 'Задачи'
+        # Вся проверка готовности к отправке - один диапазон по этому индексу
+        indexes = [
+            models.Index(fields=['next_fire_at'], condition=models.Q(next_fire_at__isnull=False), name='task_next_fire_idx'),
+        ]
     
 
+class Outbox(models.Model):
+    '''
+        Очередь отрендеренных сообщений на отправку
+    '''
+    KINDS = {
+        'pre_reminder': 'Предварительное напоминание',
+        'reminder': 'Напоминание',
+        'pre_task': 'Предварительное напоминание для задачи',
+        'task': 'Задача',
+        'transfer': 'Перенесённая задача',
+    }
+    STATUSES = {
+        'pending': 'Ожидает отправки',
+        'sent': 'Отправлено',
+        'failed': 'Не отправлено',
+    }
+
+    key = models.CharField(verbose_name='Ключ идемпотентности', max_length=100, unique=True)
+    chat_id = models.BigIntegerField(verbose_name='ID чата')
+    kind = models.CharField(verbose_name='Вид', max_length=20, choices=KINDS)
+    item_id = models.BigIntegerField(verbose_name='ID напоминания или задачи')
+    text = models.TextField(verbose_name='Текст сообщения')
+    reply_markup = models.TextField(verbose_name='Клавиатура (JSON)', null=True, blank=True)
+    due_at = models.DateTimeField(verbose_name='Плановое время')
+    created_at = models.DateTimeField(verbose_name='Создано', auto_now_add=True)
+    status = models.CharField(verbose_name='Статус', max_length=10, choices=STATUSES, default='pending')
+    attempts = models.PositiveIntegerField(verbose_name='Попыток', default=0)
+    lease_owner = models.CharField(verbose_name='Кем занято', max_length=100, blank=True)
+    lease_until = models.DateTimeField(verbose_name='Занято до', null=True, blank=True)
+    sent_at = models.DateTimeField(verbose_name='Отправлено', null=True, blank=True)
+    last_error = models.TextField(verbose_name='Последняя ошибка', blank=True)
+
+    def __str__(self):
+        return f'Сообщение {self.key} ({self.status})'
+
+    class Meta:
+        verbose_name = 'Исходящее сообщение'
+        verbose_name_plural = 'Исходящие сообщения'
+        indexes = [
+            models.Index(fields=['lease_until', 'id'], condition=models.Q(status='pending'), name='outbox_pending_idx'),
+        ]
+
+
+class DeliveryHistory(models.Model):
+    '''
+        Архив завершённых напоминаний и задач. Только добавление, без текста и ссылок на пользователя,
+        чтобы рабочие таблицы оставались маленькими
+    '''
+    ITEM_TYPES = {
+        'reminder': 'Напоминание',
+        'task': 'Задача',
+    }
+    STATUSES = {
+        'sent': 'Отправлено',
+        'completed': 'Выполнено',
+    }
+
+    item_type = models.CharField(verbose_name='Тип', max_length=10, choices=ITEM_TYPES)
+    item_id = models.BigIntegerField(verbose_name='ID элемента')
+    user_id = models.BigIntegerField(verbose_name='ID пользователя')
+    status = models.CharField(verbose_name='Статус', max_length=10, choices=STATUSES)
+    reminder_time = models.DateTimeField(verbose_name='Дата и время напоминания')
+    created_at = models.DateTimeField(verbose_name='Создано')
+    archived_at = models.DateTimeField(verbose_name='Перенесено в архив', default=timezone.now)
+
+    def __str__(self):
+        return f'{self.item_type} {self.item_id} пользователя {self.user_id} ({self.status})'
+
+    class Meta:
+        verbose_name = 'Запись истории'
+        verbose_name_plural = 'История'
+        # Ежемесячный перенос в отдельные файлы идёт диапазонами по archived_at
+        indexes = [
+            models.Index(fields=['archived_at'], name='history_archived_idx'),
+        ]
+
+
+class DispatchTick(models.Model):
+    '''
+        Метрики одного прохода рассылки. Хранятся METRICS_RETENTION_DAYS дней
+    '''
+    started_at = models.DateTimeField(verbose_name='Начало прохода', default=timezone.now, db_index=True)
+    duration_ms = models.FloatField(verbose_name='Длительность, мс', default=0)
+    scan_ms = models.FloatField(verbose_name='Выборка готовых, мс', default=0)
+    due = models.JSONField(verbose_name='Готово к отправке по видам', default=dict)
+    enqueued = models.PositiveIntegerField(verbose_name='Поставлено в очередь', default=0)
+    sent = models.PositiveIntegerField(verbose_name='Отправлено', default=0)
+    failed = models.PositiveIntegerField(verbose_name='Ошибок', default=0)
+    latency_p50_ms = models.FloatField(verbose_name='Отправка p50, мс', default=0)
+    latency_p95_ms = models.FloatField(verbose_name='Отправка p95, мс', default=0)
+    latency_p99_ms = models.FloatField(verbose_name='Отправка p99, мс', default=0)
+    lateness_p50_s = models.FloatField(verbose_name='Опоздание p50, с', default=0)
+    lateness_p99_s = models.FloatField(verbose_name='Опоздание p99, с', default=0)
+    lateness_histogram = models.JSONField(verbose_name='Гистограмма опоздания', default=dict)
+
+    def __str__(self):
+        return f'Проход рассылки {self.started_at}'
+
+    class Meta:
+        verbose_name = 'Проход рассылки'
+        verbose_name_plural = 'Проходы рассылки'
+
+
+class UpdateWatermark(models.Model):
+    '''
+        Наибольший принятый update_id входящих обновлений.
+        После перезапуска обновления, отстающие от него больше чем на UPDATE_DEDUP_WINDOW, считаются повторами
+    '''
+    name = models.CharField(verbose_name='Источник', max_length=32, primary_key=True)
+    update_id = models.BigIntegerField(verbose_name='Последний update_id', default=0)
+    updated_at = models.DateTimeField(verbose_name='Обновлено', auto_now=True)
+
+    def __str__(self):
+        return f'{self.name}: {self.update_id}'
+
+    class Meta:
+        verbose_name = 'Отметка входящих обновлений'
+        verbose_name_plural = 'Отметки входящих обновлений'
+
+
 # Путь для стартового файла
 def start_message_path(instance, filename):
     return os.path.join(f'images/start_file.{filename.split('.')[-1]}')
@@ -105,3 +307,29 @@ class GeneralInfo(models.Model):
         verbose_name = 'Общая информация'
         verbose_name_plural = 'Общая информация'
 
+
+
+class IncomingUpdate(models.Model):
+    '''
+        Принятое вебхуком обновление.
+        Строка пишется до ответа Telegram: если процесс перезапущен посреди очереди, необработанное
+        подберёт другой процесс, когда истечёт аренда. После обработки строка остаётся отметкой (processed_at),
+        чтобы повторная доставка того же update_id отсеивалась в любом процессе и после перезапуска
+    '''
+    update_id = models.BigIntegerField(verbose_name='update_id', primary_key=True)
+    payload = models.TextField(verbose_name='Обновление (JSON)')
+    received_at = models.DateTimeField(verbose_name='Получено', auto_now_add=True)
+    lease_owner = models.CharField(verbose_name='Кем занято', max_length=100, blank=True)
+    lease_until = models.DateTimeField(verbose_name='Занято до')
+    processed_at = models.DateTimeField(verbose_name='Обработано', null=True, blank=True)
+
+    def __str__(self):
+        return f'Обновление {self.update_id}'
+
+    class Meta:
+        verbose_name = 'Входящее обновление'
+        verbose_name_plural = 'Входящие обновления'
+        indexes = [
+            models.Index(fields=['lease_until', 'update_id'], condition=models.Q(processed_at__isnull=True), name='incoming_lease_idx'),
+            models.Index(fields=['processed_at'], condition=models.Q(processed_at__isnull=False), name='incoming_processed_idx'),
+        ]
@@ -0,0 +1,291 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from django.conf import settings
+from telebot.apihelper import ApiTelegramException
+
+from .metrics import percentile
+
+delivery_logger = logging.getLogger('delivery_log')
+
+# Виды ошибок отправки
+BLOCKED = 'blocked'  # пользователь заблокировал бота или чат не существует - больше не писать
+REJECTED = 'rejected'  # API отклонил само сообщение - повтор не поможет
+TRANSIENT = 'transient'  # 429, 5xx, сеть - повторить позже
+
+
+class CircuitOpenError(Exception):
+    '''
+        Bot API недоступен, отправка приостановлена
+    '''
+
+
+def classify_error(error: Exception) -> str:
+    '''
+        Определение вида ошибки отправки
+    '''
+    if isinstance(error, ApiTelegramException):
+        if error.error_code == 403 or (error.error_code == 400 and 'chat not found' in error.description.lower()):
+            return BLOCKED
+        if error.error_code == 429 or error.error_code >= 500:
+            return TRANSIENT
+        return REJECTED
+    return TRANSIENT
+
+
+def is_outage(error: Exception) -> bool:
+    '''
+        Ошибки, говорящие о недоступности самого API (а не о проблеме конкретного сообщения)
+    '''
+    if isinstance(error, ApiTelegramException):
+        return error.error_code >= 500
+    # Сетевые ошибки requests наследуются от OSError
+    return isinstance(error, OSError)
+
+
+class CircuitBreaker:
+    '''
+        После threshold ошибок подряд отправка приостанавливается на cooldown секунд,
+        затем пропускается одна пробная попытка
+    '''
+
+    def __init__(self, threshold: int, cooldown: float, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at >= self.cooldown and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened_at = self.clock()
+                self.trial = False
+
+    @property
+    def is_open(self) -> bool:
+        with self.lock:
+            return self.opened_at is not None and self.clock() - self.opened_at < self.cooldown
+
+    def retry_at(self) -> float:
+        '''
+            Момент (по clock), когда будет разрешена пробная попытка
+        '''
+        with self.lock:
+            return (self.opened_at or self.clock()) + self.cooldown
+
+
+class TokenBucket:
+    '''
+        Ведро токенов: rate токенов в секунду, не больше capacity про запас
+    '''
+
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        '''
+            Забирает токен в долг. Возвращает, сколько секунд нужно подождать до его появления
+        '''
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def is_idle(self) -> bool:
+        with self.lock:
+            return self.tokens + (self.clock() - self.updated) * self.rate >= self.capacity
+
+
+class DeliveryStats:
+    '''
+        Счётчики доставки и задержки отправки
+    '''
+
+    def __init__(self, window: int = 10000):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latencies = deque(maxlen=window)
+
+    def record(self, latency: float = None, failed: bool = False, retry: bool = False):
+        with self.lock:
+            if retry:
+                self.retries += 1
+            elif failed:
+                self.failed += 1
+            else:
+                self.sent += 1
+                self.latencies.append(latency)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            latencies = sorted(self.latencies)
+            sent, failed, retries = self.sent, self.failed, self.retries
+
+        return {
+            'sent': sent,
+            'failed': failed,
+            'retries': retries,
+            'elapsed_s': round(elapsed, 3),
+            'throughput': round(sent / elapsed, 3) if elapsed else 0,
+            'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+            'latency_p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+            'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        }
+
+
+class DeliveryPool:
+    '''
+        Пул потоков для отправки сообщений с общим лимитом бота и лимитом на чат.
+        Лимит бота делится на processes - число процессов, отправляющих одновременно
+    '''
+
+    def __init__(self, bot, workers: int = None, global_rate: float = None, chat_rate: float = None,
+                 max_retries: int = None, queue_size: int = None, processes: int = None):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate or settings.DELIVERY_GLOBAL_RATE / (processes or settings.DELIVERY_PROCESSES))
+        self.chat_rate = chat_rate or settings.DELIVERY_CHAT_RATE
+        self.max_retries = settings.DELIVERY_MAX_RETRIES if max_retries is None else max_retries
+        self.chat_buckets = {}
+        self.chat_lock = threading.Lock()
+        # Пауза всего пула после ответа 429 с retry_after
+        self.paused_until = 0
+        self.breaker = CircuitBreaker(settings.CIRCUIT_BREAKER_THRESHOLD, settings.CIRCUIT_BREAKER_COOLDOWN)
+        self.stats = DeliveryStats()
+        self.queue = queue.Queue(maxsize=queue_size or settings.DELIVERY_QUEUE_SIZE)
+        self.threads = [
+            threading.Thread(target=self.worker, name=f'delivery-{i}', daemon=True)
+            for i in range(workers or settings.DELIVERY_WORKERS)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, chat_id: int, text: str, **kwargs) -> Future:
+        '''
+            Ставит сообщение в очередь. Блокируется, если очередь заполнена
+        '''
+        future = Future()
+        self.queue.put((future, time.monotonic(), chat_id, text, kwargs))
+        return future
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        with self.chat_lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self.chat_buckets) >= 10000:
+                    self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.is_idle()}
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, capacity=1)
+            return bucket
+
+    def wait_for_slot(self, chat_id: int):
+        # Место в очереди чата резервируется раньше глобального, чтобы сообщения одного чата шли по порядку
+        delay = self.chat_bucket(chat_id).reserve()
+        delay = max(delay, self.global_bucket.reserve(), self.paused_until - time.monotonic())
+        if delay > 0:
+            time.sleep(delay)
+
+    def deliver(self, chat_id: int, text: str, kwargs: dict):
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError('Bot API недоступен, отправка приостановлена')
+            self.wait_for_slot(chat_id)
+            try:
+                result = self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                self.breaker.record_success()
+                return result
+            except Exception as e:
+                # Любой ответ API, кроме 5xx, означает, что сам API работает
+                if is_outage(e):
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if not isinstance(e, ApiTelegramException) or e.error_code != 429 or attempt >= self.max_retries:
+                    raise
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                delivery_logger.warning(f'429 для чата {chat_id}, пауза {retry_after} с')
+                self.stats.record(retry=True)
+                attempt += 1
+
+    def close(self):
+        '''
+            Останавливает потоки после того, как очередь будет разобрана
+        '''
+        for _ in self.threads:
+            self.queue.put(None)
+
+    def worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            future, queued_at, chat_id, text, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                self.queue.task_done()
+                continue
+            try:
+                result = self.deliver(chat_id, text, kwargs)
+            except Exception as e:
+                self.stats.record(failed=True)
+                future.set_exception(e)
+            else:
+                self.stats.record(latency=time.monotonic() - queued_at)
+                # Момент отправки по time.time() - для подсчёта опоздания относительно планового времени
+                future.finished_at = time.time()
+                future.set_result(result)
+            finally:
+                self.queue.task_done()
+
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_delivery_pool(bot, processes: int = None) -> DeliveryPool:
+    '''
+        Общий пул процесса, создаётся при первой отправке
+    '''
+    global pool
+    with pool_lock:
+        if pool is None or pool.bot is not bot:
+            if pool is not None:
+                pool.close()
+            pool = DeliveryPool(bot, processes=processes)
+        return pool
@@ -0,0 +1,114 @@
+import datetime
+import os
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+from django.db import connection
+
+from .delivery import CircuitBreaker
+from .outbox import drain_outbox, enqueue_due
+
+
+class DryRunPool:
+    '''
+        Пул отправки для прогона: ничего не отправляет, только запоминает сообщения
+    '''
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(threshold=10 ** 9, cooldown=0)
+        self.sent = []
+
+    def submit(self, chat_id: int, text: str, **kwargs) -> Future:
+        self.sent.append(chat_id)
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+class QueryTimer:
+    '''
+        Суммарное время запросов к базе (connection.execute_wrapper)
+    '''
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.queries += 1
+
+
+def replay(start: datetime.datetime, until: datetime.datetime, step: int = 60) -> dict:
+    '''
+        Прогон рассылки по шагам фиктивных часов от start до until.
+        Изменения в базе остаются: вызывать внутри откатываемой транзакции или на копии базы
+    '''
+    # Всё, что по фиктивным часам ушло бы до начала прогона, отправляется без учёта,
+    # иначе первый шаг вобрал бы всё, что накопилось между настоящим временем и start
+    before = start - datetime.timedelta(seconds=step)
+    skipped = enqueue_due(now=before)
+    drain_outbox(DryRunPool(), now=before)
+
+    steps = []
+    now = start
+    while now <= until:
+        pool = DryRunPool()
+        timer = QueryTimer()
+        with connection.execute_wrapper(timer):
+            enqueued = enqueue_due(now=now)
+            counters = drain_outbox(pool, now=now)
+        per_chat = Counter(pool.sent)
+        steps.append({
+            'at': now,
+            'items': enqueued,
+            'messages': len(pool.sent),
+            'delivered': counters['sent'],
+            'max_per_chat': max(per_chat.values(), default=0),
+            'db_ms': round(timer.seconds * 1000, 3),
+            'queries': timer.queries,
+        })
+        now += datetime.timedelta(seconds=step)
+
+    busiest = max(steps, key=lambda row: row['messages'], default=None)
+    minutes = max(len(steps) * step / 60, 1)
+    messages = sum(row['messages'] for row in steps)
+    return {
+        'steps': steps,
+        'skipped': skipped,
+        'messages': messages,
+        'items': sum(row['items'] for row in steps),
+        'messages_per_minute': round(messages / minutes, 3),
+        'peak_burst': busiest['messages'] if busiest else 0,
+        'peak_at': busiest['at'] if busiest else None,
+        'peak_per_chat': max((row['max_per_chat'] for row in steps), default=0),
+        'db_ms': round(sum(row['db_ms'] for row in steps), 3),
+        'db_ms_max': max((row['db_ms'] for row in steps), default=0),
+    }
+
+
+def copy_sqlite_database() -> str:
+    '''
+        Переключение соединения на временную копию базы SQLite (backup API, без остановки бота).
+        Возвращает путь к копии или None для других СУБД
+    '''
+    if connection.vendor != 'sqlite':
+        return None
+    handle, path = tempfile.mkstemp(suffix='.sqlite3')
+    os.close(handle)
+    connection.ensure_connection()
+    target = sqlite3.connect(path)
+    try:
+        connection.connection.backup(target)
+    finally:
+        target.close()
+    connection.close()
+    connection.settings_dict['NAME'] = path
+    return path
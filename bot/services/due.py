@@ -0,0 +1,123 @@
+import datetime
+from collections import namedtuple
+from itertools import chain
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from ..models import Reminder, Task
+from .recurrence import is_finished_occurrence, rearm
+
+DueItems = namedtuple('DueItems', ['pre_reminders', 'reminders', 'pre_tasks', 'tasks', 'transfers'])
+
+# Поля, по которым видно, что строку изменили после выборки (завершение, перенос, редактирование)
+STATE_FIELDS = {
+    Reminder: ('reminder_time', 'pre_reminder_time', 'is_pre_reminder_sent', 'is_main_reminder_sent', 'next_fire_at', 'next_fire_kind'),
+    Task: ('reminder_time', 'pre_reminder_time', 'is_pre_reminder_sent', 'is_main_reminder_sent', 'next_fire_at', 'next_fire_kind',
+           'is_completed', 'is_transfered', 'transfer_time'),
+}
+
+
+def collect_due(now: datetime.datetime = None, limit: int = None) -> DueItems:
+    '''
+        Выборка всех напоминаний и задач, которые пора отправить.
+        По одному ограниченному диапазону next_fire_at <= now на модель, распределение по видам - в памяти
+    '''
+    now = now or timezone.now()
+    limit = limit or settings.DUE_BATCH_SIZE
+    due = DueItems([], [], [], [], [])
+
+    # Пользователи, заблокировавшие бота, пропускаются. Профиль нужен для обращения и тона в тексте сообщения
+    reminders = list(Reminder.objects.filter(next_fire_at__lte=now, user__is_blocked=False).select_related('user').order_by('next_fire_at')[:limit])
+    tasks = list(Task.objects.filter(next_fire_at__lte=now, user__is_blocked=False).select_related('user').order_by('next_fire_at')[:limit])
+
+    for item in reminders + tasks:
+        # Состояние на момент выборки: mark_sent по нему узнаёт, что строку успели изменить
+        item.loaded_state = loaded_state(item)
+        if item.next_fire_kind == 'pre' and item.reminder_time <= now:
+            # Основное время тоже наступило (простой, напоминание на ближайшие минуты) - предупреждать уже поздно
+            item.next_fire_at, item.next_fire_kind = item.reminder_time, 'main'
+
+    for reminder in reminders:
+        if reminder.next_fire_kind == 'pre':
+            due.pre_reminders.append(reminder)
+        else:
+            due.reminders.append(reminder)
+
+    for task in tasks:
+        if task.next_fire_kind == 'pre':
+            due.pre_tasks.append(task)
+        elif task.next_fire_kind == 'transfer':
+            due.transfers.append(task)
+        else:
+            due.tasks.append(task)
+
+    return due
+
+
+def loaded_state(item) -> tuple:
+    return tuple(getattr(item, field) for field in STATE_FIELDS[type(item)])
+
+
+def unchanged(model, items: list) -> set:
+    '''
+        id строк, которые с момента выборки никто не менял. Строки перечитываются с блокировкой (SELECT ... FOR UPDATE),
+        поэтому до конца транзакции их уже не изменит параллельное завершение или перенос задачи
+    '''
+    if not items:
+        return set()
+    expected = {item.id: getattr(item, 'loaded_state', None) or loaded_state(item) for item in items}
+    current = model.objects.select_for_update().filter(id__in=expected).values_list('id', *STATE_FIELDS[model])
+    return {row[0] for row in current if row[1:] == expected[row[0]]}
+
+
+def mark_sent(due: DueItems, now: datetime.datetime = None) -> DueItems:
+    '''
+        Отметка обработанных элементов и пересчёт их next_fire_at:
+        по одному UPDATE на модель в одной транзакции.
+        Повторяющиеся элементы, отработавшие текущее повторение, в том же UPDATE переводятся на следующее.
+        Элементы, изменённые после выборки (например, задачу завершили), пропускаются, чтобы не затереть изменение.
+        Возвращает отмеченные элементы
+    '''
+    now = now or timezone.now()
+    with transaction.atomic():
+        current = {model: unchanged(model, [item for item in chain(*due) if isinstance(item, model)]) for model in (Reminder, Task)}
+        due = DueItems(*([item for item in items if item.id in current[type(item)]] for items in due))
+        update_sent(due, now)
+    return due
+
+
+def update_sent(due: DueItems, now: datetime.datetime):
+    '''
+        Установка флагов и next_fire_at уже проверенных элементов
+    '''
+    for reminder in due.pre_reminders:
+        reminder.is_pre_reminder_sent = True
+    for reminder in due.reminders:
+        reminder.is_main_reminder_sent = True
+    for task in due.pre_tasks:
+        task.is_pre_reminder_sent = True
+    for task in due.tasks:
+        task.is_main_reminder_sent = True
+    for task in due.transfers:
+        # Перенос срабатывает один раз, дальше задача ждёт нового переноса или завершения
+        task.is_transfered = False
+
+    reminders = due.pre_reminders + due.reminders
+    tasks = due.pre_tasks + due.tasks + due.transfers
+    rearmed = False
+    for item in reminders + tasks:
+        if is_finished_occurrence(item):
+            rearm(item, now)
+            rearmed = True
+        else:
+            item.update_next_fire()
+
+    fields = ['is_pre_reminder_sent', 'is_main_reminder_sent', 'next_fire_at', 'next_fire_kind']
+    if rearmed:
+        fields += ['reminder_time', 'pre_reminder_time', 'repeat_time']
+    if reminders:
+        Reminder.objects.bulk_update(reminders, fields)
+    if tasks:
+        Task.objects.bulk_update(tasks, fields + ['is_transfered'] if due.transfers else fields)
@@ -0,0 +1,63 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+identity_logger = logging.getLogger('identity_log')
+
+identity = None
+identity_lock = threading.Lock()
+
+
+def token_bot_id() -> str:
+    # Первая часть токена - id бота, по ней видно, что кэш остался от другого бота
+    return settings.BOT_TOKEN.split(':')[0]
+
+
+def read_cache() -> dict:
+    try:
+        with open(settings.BOT_IDENTITY_CACHE, encoding='utf-8') as file:
+            cached = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return cached if str(cached.get('id')) == token_bot_id() else None
+
+
+def write_cache(data: dict):
+    # Запись через временный файл, чтобы параллельный процесс не прочитал половину
+    path = settings.BOT_IDENTITY_CACHE
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def get_identity(bot, refresh: bool = False) -> dict:
+    '''
+        Данные бота из getMe (id, username, first_name).
+        Запрашиваются при первом обращении и хранятся в BOT_IDENTITY_CACHE,
+        поэтому обычный запуск процесса обходится без сети
+    '''
+    global identity
+    with identity_lock:
+        if identity is None or refresh:
+            identity = None if refresh else read_cache()
+            if identity is None:
+                me = bot.get_me()
+                identity = {'id': me.id, 'username': me.username, 'first_name': me.first_name, 'fetched_at': int(time.time())}
+                write_cache(identity)
+        return identity
+
+
+def setup_bot(bot):
+    '''
+        Разовая настройка бота в Telegram: список команд и обновление кэша getMe.
+        Выполняется командой bot_setup и при установке вебхука, а не при каждом импорте
+    '''
+    bot.set_my_commands(settings.BOT_COMMANDS)
+    me = get_identity(bot, refresh=True)
+    identity_logger.info(f'@{me["username"]} настроен')
+    return me
@@ -0,0 +1,85 @@
+import datetime
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.utils import timezone
+
+from ..models import DispatchTick
+
+
+def percentile(values: list, p: float) -> float:
+    '''
+        Перцентиль по отсортированному списку
+    '''
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def lateness_histogram(values: list, buckets: tuple = None) -> dict:
+    '''
+        Количество значений в каждой корзине: ключ - верхняя граница в секундах, последняя корзина '+Inf'
+    '''
+    buckets = buckets or settings.LATENESS_BUCKETS
+    histogram = {str(bound): 0 for bound in buckets}
+    histogram['+Inf'] = 0
+    for value in values:
+        bound = next((bound for bound in buckets if value <= bound), None)
+        histogram['+Inf' if bound is None else str(bound)] += 1
+    return histogram
+
+
+class TickMetrics:
+    '''
+        Сбор метрик одного прохода рассылки: выборка, очередь и отправка
+    '''
+
+    def __init__(self):
+        self.started_at = timezone.now()
+        self.started = time.monotonic()
+        self.scan_s = 0.0
+        self.due = Counter()
+        self.enqueued = 0
+        self.failed = 0
+        self.latencies = []
+        self.lateness = []
+
+    def record_scan(self, elapsed: float, due):
+        self.scan_s += elapsed
+        for kind, items in due._asdict().items():
+            self.due[kind] += len(items)
+
+    def record_sent(self, submitted_at: float, finished_at: float, due_at: datetime.datetime):
+        '''
+            submitted_at и finished_at - время по time.time()
+        '''
+        self.latencies.append(finished_at - submitted_at)
+        self.lateness.append(finished_at - due_at.timestamp())
+
+    def record_failed(self, count: int = 1):
+        self.failed += count
+
+    def save(self) -> DispatchTick:
+        '''
+            Сохранение прохода и удаление метрик старше METRICS_RETENTION_DAYS
+        '''
+        latencies = sorted(self.latencies)
+        lateness = sorted(self.lateness)
+        tick = DispatchTick.objects.create(
+            started_at=self.started_at,
+            duration_ms=round((time.monotonic() - self.started) * 1000, 3),
+            scan_ms=round(self.scan_s * 1000, 3),
+            due=dict(self.due),
+            enqueued=self.enqueued,
+            sent=len(latencies),
+            failed=self.failed,
+            latency_p50_ms=round(percentile(latencies, 0.5) * 1000, 3),
+            latency_p95_ms=round(percentile(latencies, 0.95) * 1000, 3),
+            latency_p99_ms=round(percentile(latencies, 0.99) * 1000, 3),
+            lateness_p50_s=round(percentile(lateness, 0.5), 3),
+            lateness_p99_s=round(percentile(lateness, 0.99), 3),
+            lateness_histogram=lateness_histogram(lateness),
+        )
+        DispatchTick.objects.filter(started_at__lt=self.started_at - datetime.timedelta(days=settings.METRICS_RETENTION_DAYS)).delete()
+        return tick
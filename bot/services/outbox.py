@@ -0,0 +1,278 @@
+import datetime
+import logging
+import os
+import socket
+import threading
+import time
+from itertools import chain
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q, Subquery
+from django.utils import timezone
+
+from ..models import Outbox, Reminder, Task, UserProfile
+from .delivery import BLOCKED, REJECTED, CircuitOpenError, classify_error
+from .due import collect_due, mark_sent
+from .templates import render_message, task_markup
+
+outbox_logger = logging.getLogger('outbox_log')
+
+# Модель элемента для каждого вида сообщения
+KIND_MODELS = {'pre_reminder': Reminder, 'reminder': Reminder, 'pre_task': Task, 'task': Task, 'transfer': Task}
+
+
+def outbox_row(kind: str, item, text: str, reply_markup: str = None) -> Outbox:
+    # Плановое время - момент срабатывания, по которому элемент был выбран (по нему считается опоздание)
+    due_at = item.next_fire_at
+    return Outbox(
+        # Ключ включает плановое время, чтобы повторения и переносы давали новые сообщения
+        key=f'{kind}:{item.id}:{int(due_at.timestamp())}',
+        chat_id=item.user_id,
+        kind=kind,
+        item_id=item.id,
+        text=text,
+        reply_markup=reply_markup,
+        due_at=due_at,
+    )
+
+
+def render_due(due, now: datetime.datetime = None) -> list[Outbox]:
+    '''
+        Превращение готовых элементов в сообщения очереди. now - момент прохода, от него считается
+        оставшееся время в предварительных напоминаниях
+    '''
+    now = now or timezone.now()
+    rows = []
+    for kind, items in (('pre_reminder', due.pre_reminders), ('reminder', due.reminders), ('pre_task', due.pre_tasks)):
+        rows.extend(outbox_row(kind, item, render_message(kind, item, now)) for item in items)
+    for kind, tasks in (('task', due.tasks), ('transfer', due.transfers)):
+        rows.extend(outbox_row(kind, task, render_message(kind, task, now), reply_markup=task_markup(task.id)) for task in tasks)
+    return rows
+
+
+def enqueue_due(now: datetime.datetime = None, metrics=None) -> int:
+    '''
+        Этап планирования: готовые элементы попадают в очередь, флаги ставятся в той же транзакции.
+        Падение до коммита ничего не теряет, после коммита - ничего не дублирует.
+        Параллельные планировщики не создают дублей благодаря уникальному ключу
+    '''
+    enqueued = 0
+    while True:
+        # Каждый проход сдвигает next_fire_at обработанных элементов, поэтому цикл конечен:
+        # просроченное напоминание сначала даёт основное сообщение, затем предварительное
+        tick = now or timezone.now()
+        started = time.monotonic()
+        due = collect_due(now=tick)
+        if metrics:
+            metrics.record_scan(time.monotonic() - started, due)
+        rows = render_due(due, now=tick)
+        if not rows:
+            break
+        with transaction.atomic():
+            # Элементы, изменённые после выборки (задачу завершили или перенесли), в очередь не попадают
+            marked = {(type(item), item.id) for item in chain(*mark_sent(due, now=tick))}
+            rows = [row for row in rows if (KIND_MODELS[row.kind], row.item_id) in marked]
+            Outbox.objects.bulk_create(rows, batch_size=500, ignore_conflicts=True)
+        if not rows:
+            # Всё выбранное успели изменить - следующий проход планировщика выберет заново
+            break
+        enqueued += len(rows)
+    if metrics:
+        metrics.enqueued += enqueued
+    return enqueued
+
+
+def overdue_text(delta: datetime.timedelta) -> str:
+    minutes = int(delta.total_seconds() // 60)
+    if minutes < 60:
+        return f'{minutes} мин'
+    return f'{minutes // 60} ч {minutes % 60} мин'
+
+
+def digest_messages(rows: list[Outbox], now: datetime.datetime) -> list[tuple[list[Outbox], str]]:
+    '''
+        Сводка из нескольких сообщений одному пользователю.
+        Слишком длинная сводка делится на несколько сообщений, каждое - со своим списком строк очереди
+    '''
+    catch_up = now - min(row.due_at for row in rows) > datetime.timedelta(minutes=settings.DIGEST_CATCHUP_MINUTES)
+    if catch_up:
+        header = f"⌛ Пока бот не мог отправлять сообщения, накопились напоминания ({len(rows)}):"
+    else:
+        header = f"📋 Сразу несколько напоминаний ({len(rows)}):"
+
+    messages = []
+    current, text = [], header
+    for row in rows:
+        item = row.text
+        if catch_up:
+            item += f"\n⏱ Было запланировано {overdue_text(now - row.due_at)} назад"
+        if current and len(text) + len(item) + 2 > settings.MESSAGE_MAX_LENGTH:
+            messages.append((current, text))
+            current, text = [], header
+        current.append(row)
+        text += "\n\n" + item
+    messages.append((current, text))
+    return messages
+
+
+def coalesce(batch: list[Outbox], now: datetime.datetime) -> list[tuple[list[Outbox], str, str]]:
+    '''
+        Группировка пачки по пользователю: сообщения без кнопок сверх порога объединяются в сводку.
+        Сообщения с кнопками (задачи) всегда уходят отдельно - кнопки привязаны к конкретной задаче
+    '''
+    mergeable = {}
+    # Порядок сообщений сохраняется: сводка занимает место первого сообщения пользователя
+    order = []
+    for row in batch:
+        if row.reply_markup:
+            order.append(row)
+        elif row.chat_id not in mergeable:
+            mergeable[row.chat_id] = [row]
+            order.append(row.chat_id)
+        else:
+            mergeable[row.chat_id].append(row)
+
+    messages = []
+    for entry in order:
+        if isinstance(entry, Outbox):
+            messages.append(([entry], entry.text, entry.reply_markup))
+            continue
+        rows = mergeable[entry]
+        if len(rows) > settings.DIGEST_THRESHOLD:
+            messages.extend((part, text, None) for part, text in digest_messages(rows, now))
+        else:
+            messages.extend(([row], row.text, None) for row in rows)
+    return messages
+
+
+def default_worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def claim_batch(now: datetime.datetime, limit: int = None, worker: str = None, key_prefix: str = None) -> list[Outbox]:
+    '''
+        Берёт в аренду пачку ожидающих сообщений. Просроченная аренда (упавший процесс) снова доступна.
+        На PostgreSQL строки выбираются через SELECT ... FOR UPDATE SKIP LOCKED,
+        на SQLite - одним условным UPDATE (запись там и так идёт по одной).
+        key_prefix ограничивает выборку строками с таким началом ключа (бенчмарки не трогают настоящую очередь)
+    '''
+    limit = limit or settings.OUTBOX_BATCH_SIZE
+    worker = worker or default_worker_id()
+    available = Q(status='pending') & (Q(lease_until__isnull=True) | Q(lease_until__lte=now))
+    if key_prefix:
+        available &= Q(key__startswith=key_prefix)
+    lease = dict(
+        lease_owner=worker,
+        lease_until=now + datetime.timedelta(seconds=settings.OUTBOX_LEASE_SECONDS),
+        attempts=F('attempts') + 1,
+    )
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(
+                Outbox.objects.select_for_update(skip_locked=True).filter(available)
+                .order_by('id').values_list('id', flat=True)[:limit]
+            )
+            if not ids:
+                return []
+            Outbox.objects.filter(id__in=ids).update(**lease)
+    else:
+        candidates = Outbox.objects.filter(available).order_by('id').values('id')[:limit]
+        # Условие повторяется во внешнем UPDATE, чтобы не перехватить строку, занятую другим процессом
+        if not Outbox.objects.filter(available, id__in=Subquery(candidates)).update(**lease):
+            return []
+
+    return list(Outbox.objects.filter(status='pending', lease_owner=worker, lease_until=lease['lease_until']).order_by('id'))
+
+
+def backoff(attempts: int) -> datetime.timedelta:
+    '''
+        Экспоненциальная пауза перед следующей попыткой
+    '''
+    seconds = settings.DELIVERY_BACKOFF_BASE * 2 ** max(attempts - 1, 0)
+    return datetime.timedelta(seconds=min(seconds, settings.DELIVERY_BACKOFF_MAX))
+
+
+def release_failed(errors: list, worker: str, pool):
+    '''
+        Разбор ошибок отправки: повтор позже, окончательная ошибка или блокировка пользователя
+    '''
+    now = timezone.now()
+    failed = {}
+    retry = {}
+    blocked_chats = set()
+    for row, error in errors:
+        kind = classify_error(error)
+        if isinstance(error, CircuitOpenError):
+            # Попытка не состоялась: возвращаем её и ждём конца паузы
+            delay = datetime.timedelta(seconds=max(pool.breaker.retry_at() - time.monotonic(), 0))
+            Outbox.objects.filter(id=row.id, lease_owner=worker).update(
+                lease_until=now + delay, attempts=F('attempts') - 1, last_error=str(error)
+            )
+        elif kind == BLOCKED:
+            blocked_chats.add(row.chat_id)
+            failed.setdefault(str(error), []).append(row.id)
+        elif kind == REJECTED or row.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+            failed.setdefault(str(error), []).append(row.id)
+        else:
+            retry.setdefault((row.attempts, str(error)), []).append(row.id)
+
+    for error, ids in failed.items():
+        Outbox.objects.filter(id__in=ids, lease_owner=worker).update(status='failed', last_error=error, lease_until=None)
+    for (attempts, error), ids in retry.items():
+        Outbox.objects.filter(id__in=ids, lease_owner=worker).update(last_error=error, lease_until=now + backoff(attempts))
+    if blocked_chats:
+        UserProfile.objects.filter(user_id__in=blocked_chats).update(is_blocked=True)
+        Outbox.objects.filter(chat_id__in=blocked_chats, status='pending').update(status='failed', last_error='Пользователь заблокировал бота')
+        outbox_logger.warning(f'Пользователи заблокировали бота: {sorted(blocked_chats)}')
+
+
+def drain_outbox(pool, now: datetime.datetime = None, worker: str = None, batch_size: int = None, metrics=None,
+                 key_prefix: str = None) -> dict:
+    '''
+        Этап доставки: отправка сообщений из очереди пачками до её опустошения.
+        Несколько процессов могут разбирать очередь одновременно, каждый берёт свои пачки в аренду.
+        Ошибка одного сообщения не мешает остальным.
+        Несколько сообщений одному пользователю в пачке объединяются в сводку (см. coalesce)
+    '''
+    counters = {'sent': 0, 'failed': 0}
+    worker = worker or default_worker_id()
+    while not pool.breaker.is_open:
+        claimed_at = now or timezone.now()
+        batch = claim_batch(claimed_at, limit=batch_size, worker=worker, key_prefix=key_prefix)
+        if not batch:
+            break
+        deliveries = [
+            (rows, time.time(), pool.submit(chat_id=rows[0].chat_id, text=text, reply_markup=reply_markup))
+            for rows, text, reply_markup in coalesce(batch, claimed_at)
+        ]
+        sent_ids = []
+        errors = []
+        for rows, submitted_at, future in deliveries:
+            try:
+                future.result()
+            except Exception as e:
+                # Сводка целиком считается неотправленной: каждая её строка повторяется по своим правилам
+                errors.extend((row, e) for row in rows)
+                outbox_logger.error(f'Не удалось отправить {", ".join(row.key for row in rows)}: {e}')
+                continue
+            sent_ids.extend(row.id for row in rows)
+            if metrics:
+                for row in rows:
+                    metrics.record_sent(submitted_at, getattr(future, 'finished_at', time.time()), row.due_at)
+
+        with transaction.atomic():
+            if sent_ids:
+                Outbox.objects.filter(id__in=sent_ids, lease_owner=worker).update(status='sent', sent_at=timezone.now(), lease_until=None)
+            if errors:
+                release_failed(errors, worker, pool)
+
+        counters['sent'] += len(sent_ids)
+        counters['failed'] += len(errors)
+        if metrics:
+            metrics.record_failed(len(errors))
+
+    if pool.breaker.is_open:
+        outbox_logger.warning('Bot API недоступен, разбор очереди приостановлен')
+    return counters
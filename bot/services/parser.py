@@ -440,8 +440,8 @@ def parse_reminder_time(text: str, user) -> tuple[datetime, datetime, str, str]:
     if not reminder_time:
         return None, None, text, None
     
-    # Создаем время для предварительного напоминания (за 15 минут)
-    pre_reminder_time = reminder_time - timedelta(minutes=15)
+    # Создаем время для предварительного напоминания (за сколько минут - настройка пользователя)
+    pre_reminder_time = reminder_time - timedelta(minutes=user.pre_reminder_minutes)
         
     if user.pk:
         utc_offset = int(user.timezone[1:])
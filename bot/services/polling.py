@@ -0,0 +1,110 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .updates import QueueFull, UpdateExecutor
+
+polling_logger = logging.getLogger('polling_log')
+
+
+class Poller:
+    '''
+        Получение обновлений через getUpdates вместо вебхука.
+        Поток опроса только забирает обновления и раздаёт их пулу UpdateExecutor, не дожидаясь обработчиков.
+        Обновление подтверждается (offset) лишь после того, как его обработка закончилась:
+        offset - наименьший номер, который ещё в работе, поэтому при падении необработанное придёт снова
+    '''
+
+    def __init__(self, bot, handle, workers: int = None, limit: int = None, timeout: int = None,
+                 busy_interval: float = None, stats_interval: float = None):
+        self.bot = bot
+        self.handle = handle
+        self.limit = limit or settings.POLLING_LIMIT
+        self.timeout = timeout or settings.POLLING_TIMEOUT
+        self.busy_interval = busy_interval or settings.POLLING_BUSY_INTERVAL
+        self.stats_interval = stats_interval or settings.POLLING_STATS_INTERVAL
+        self.executor = UpdateExecutor(self.process, workers=workers)
+        self.progress = threading.Condition()
+        # Полученные, но ещё не обработанные обновления и наибольший полученный номер
+        self.in_flight = set()
+        self.fetched = 0
+        self.stop_event = threading.Event()
+
+    def offset(self) -> int:
+        with self.progress:
+            return min(self.in_flight) if self.in_flight else self.fetched + 1
+
+    def process(self, update):
+        try:
+            self.handle(update)
+        finally:
+            with self.progress:
+                self.in_flight.discard(update.update_id)
+                self.progress.notify_all()
+
+    def fetch(self, offset: int) -> int:
+        '''
+            Один запрос getUpdates. Возвращает количество новых обновлений, переданных в обработку
+        '''
+        # Пока есть необработанные, Telegram сразу отдаёт их снова - тогда ждать новых не нужно
+        timeout = self.timeout if offset > self.fetched else 1
+        updates = self.bot.get_updates(offset=offset, limit=self.limit, timeout=timeout + 5,
+                                       long_polling_timeout=timeout, allowed_updates=['message', 'callback_query'])
+        new = 0
+        for update in updates:
+            with self.progress:
+                # Уже в работе или обработано, но ещё не подтверждено
+                if update.update_id <= self.fetched:
+                    continue
+                self.in_flight.add(update.update_id)
+                self.fetched = update.update_id
+            try:
+                self.executor.submit(update)
+            except QueueFull:
+                # Очередь чата заполнена: это и следующие обновления придут в следующем запросе
+                with self.progress:
+                    self.in_flight.discard(update.update_id)
+                    self.fetched = update.update_id - 1
+                break
+            new += 1
+        return new
+
+    def snapshot(self) -> dict:
+        snapshot = self.executor.snapshot()
+        with self.progress:
+            snapshot['in_flight'] = len(self.in_flight)
+        snapshot['offset'] = self.offset()
+        return snapshot
+
+    def run(self):
+        polling_logger.info('Опрос getUpdates запущен')
+        next_stats = time.monotonic() + self.stats_interval
+        while not self.stop_event.is_set():
+            offset = self.offset()
+            try:
+                new = self.fetch(offset)
+            except Exception as e:
+                polling_logger.error(f'Ошибка getUpdates: {e}')
+                self.stop_event.wait(self.busy_interval)
+                continue
+            if not new and offset <= self.fetched:
+                # Ничего нового, ждём окончания обработки, чтобы не спрашивать то же самое впустую
+                with self.progress:
+                    self.progress.wait_for(lambda: not self.in_flight or min(self.in_flight) != offset, timeout=self.busy_interval)
+            if time.monotonic() >= next_stats:
+                polling_logger.info(f'Очередь обновлений: {self.snapshot()}')
+                next_stats = time.monotonic() + self.stats_interval
+
+        # Дорабатываем полученное и подтверждаем его, новых обновлений не берём
+        self.executor.join()
+        self.executor.close()
+        try:
+            self.bot.get_updates(offset=self.offset(), limit=1, timeout=6, long_polling_timeout=1)
+        except Exception as e:
+            polling_logger.error(f'Не удалось подтвердить обработанные обновления: {e}')
+        polling_logger.info(f'Опрос getUpdates остановлен: {self.snapshot()}')
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,42 @@
+import datetime
+
+# Период повторения для каждого типа из Reminder.REPEAT_TYPES и Task.REPEAT_TYPES
+REPEAT_PERIODS = {
+    'daily': datetime.timedelta(days=1),
+    'daily_morning': datetime.timedelta(days=1),
+    'daily_evening': datetime.timedelta(days=1),
+    'weekly': datetime.timedelta(weeks=1),
+}
+
+
+def next_occurrence(reminder_time: datetime.datetime, repeat_type: str, now: datetime.datetime) -> datetime.datetime:
+    '''
+        Ближайшее повторение строго позже now. Пропущенные за время простоя повторения не навёрстываются
+    '''
+    period = REPEAT_PERIODS[repeat_type]
+    next_time = reminder_time + period
+    if next_time <= now:
+        next_time += period * ((now - next_time) // period + 1)
+    return next_time
+
+
+def is_finished_occurrence(item) -> bool:
+    '''
+        Повторяющийся элемент, у которого отправлено основное напоминание текущего повторения
+        (предварительное всегда уходит раньше основного или не уходит вовсе)
+    '''
+    return item.repeat_type in REPEAT_PERIODS and item.is_main_reminder_sent
+
+
+def rearm(item, now: datetime.datetime):
+    '''
+        Перевод повторяющегося элемента на следующее повторение на месте, без создания новой строки
+    '''
+    lead = item.reminder_time - item.pre_reminder_time
+    item.reminder_time = next_occurrence(item.reminder_time, item.repeat_type, now)
+    item.pre_reminder_time = item.reminder_time - lead
+    item.repeat_time = item.reminder_time + REPEAT_PERIODS[item.repeat_type]
+    item.is_pre_reminder_sent = False
+    item.is_main_reminder_sent = False
+    # Ожидающий перенос задачи не трогаем: он снимается при собственной отправке
+    item.update_next_fire()
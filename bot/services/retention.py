@@ -0,0 +1,147 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from ..models import DeliveryHistory, Outbox, Reminder, Task
+
+# Что попадает в архив при удалении: тип элемента и итоговый статус. Очередь удаляется без архива
+ARCHIVED = {
+    'reminders': ('reminder', 'sent'),
+    'tasks': ('task', 'completed'),
+}
+
+
+def finished_querysets(now: datetime.datetime) -> dict:
+    '''
+        Что можно удалять: разовые напоминания, которым больше нечего отправлять,
+        выполненные разовые задачи и старые обработанные сообщения очереди.
+        Повторяющиеся и ещё не отправленные элементы не трогаются
+    '''
+    return {
+        'reminders': Reminder.objects.filter(repeat_type=None, is_main_reminder_sent=True, next_fire_at=None, reminder_time__lte=now),
+        'tasks': Task.objects.filter(repeat_type=None, is_completed=True),
+        'outbox': Outbox.objects.filter(~Q(status='pending'), created_at__lte=now - datetime.timedelta(days=settings.RETENTION_OUTBOX_DAYS)),
+    }
+
+
+def archive_rows(queryset, ids: list, item_type: str, status: str, now: datetime.datetime) -> list:
+    '''
+        Копирование удаляемых строк в архив одним INSERT. Возвращает ID скопированных строк
+    '''
+    rows = list(queryset.filter(pk__in=ids).values_list('id', 'user_id', 'reminder_time', 'created_at'))
+    DeliveryHistory.objects.bulk_create([
+        DeliveryHistory(item_type=item_type, item_id=item_id, user_id=user_id, status=status,
+                        reminder_time=reminder_time, created_at=created_at, archived_at=now)
+        for item_id, user_id, reminder_time, created_at in rows
+    ], batch_size=500)
+    return [row[0] for row in rows]
+
+
+def purge_queryset(queryset, deadline: float, chunk: int, pause: float, archive: tuple = None) -> dict:
+    '''
+        Удаление порциями по возрастанию PK, каждая порция - в своей короткой транзакции.
+        С archive строки в той же транзакции переносятся в DeliveryHistory
+    '''
+    stats = {'rows': 0, 'chunks': 0, 'lock_s': 0.0, 'max_lock_ms': 0.0, 'done': False}
+    last_pk = 0
+    while time.monotonic() < deadline:
+        ids = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk])
+        if not ids:
+            stats['done'] = True
+            break
+        started = time.monotonic()
+        last_pk = ids[-1]
+        with transaction.atomic():
+            if archive:
+                ids = archive_rows(queryset, ids, *archive, timezone.now())
+            # Условие проверяется повторно: строка могла измениться между выборкой и удалением
+            deleted, _ = queryset.filter(pk__in=ids).delete()
+        lock = time.monotonic() - started
+        stats['rows'] += deleted
+        stats['chunks'] += 1
+        stats['lock_s'] += lock
+        stats['max_lock_ms'] = max(stats['max_lock_ms'], lock * 1000)
+        # Пауза даёт вебхуку и рассылке взять блокировку записи между порциями
+        time.sleep(pause)
+    return stats
+
+
+def purge_finished(now: datetime.datetime = None, budget: float = None, chunk: int = None, pause: float = None) -> dict:
+    '''
+        Очистка завершённых элементов в пределах бюджета времени.
+        Не успевшее удалиться останется на следующий запуск
+    '''
+    now = now or timezone.now()
+    budget = settings.RETENTION_TIME_BUDGET if budget is None else budget
+    chunk = chunk or settings.RETENTION_CHUNK_SIZE
+    pause = settings.RETENTION_PAUSE if pause is None else pause
+
+    started = time.monotonic()
+    deadline = started + budget
+    report = {}
+    for name, queryset in finished_querysets(now).items():
+        report[name] = purge_queryset(queryset, deadline, chunk, pause, ARCHIVED.get(name))
+
+    elapsed = time.monotonic() - started
+    rows = sum(stats['rows'] for stats in report.values())
+    report['total'] = {
+        'rows': rows,
+        'elapsed_s': round(elapsed, 3),
+        'rows_per_s': round(rows / elapsed, 1) if elapsed else 0,
+        'lock_s': round(sum(stats['lock_s'] for stats in report.values()), 3),
+        'max_lock_ms': round(max(stats['max_lock_ms'] for stats in report.values()), 3),
+        'done': all(stats['done'] for stats in report.values()),
+    }
+    return report
+
+
+def next_month(month: datetime.datetime) -> datetime.datetime:
+    return month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+
+
+def rollover_history(before: datetime.datetime = None) -> dict:
+    '''
+        Перенос архива за завершённые месяцы из основной базы.
+        SQLite: в отдельный файл на каждый месяц (ATTACH), PostgreSQL: в отдельную таблицу на каждый месяц.
+        Возвращает количество перенесённых строк по месяцам
+    '''
+    before = before or timezone.localtime().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    table = DeliveryHistory._meta.db_table
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in DeliveryHistory._meta.concrete_fields)
+    moved = {}
+
+    for month in DeliveryHistory.objects.filter(archived_at__lt=before).datetimes('archived_at', 'month'):
+        queryset = DeliveryHistory.objects.filter(archived_at__gte=month, archived_at__lt=min(next_month(month), before))
+        # Параметры уже приведены к формату базы, поэтому подходят для «сырого» INSERT ... SELECT
+        select, params = queryset.query.sql_with_params()
+        suffix = f'{month:%Y_%m}'
+
+        if connection.vendor == 'sqlite':
+            settings.HISTORY_ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+            path = settings.HISTORY_ARCHIVE_DIR / f'history_{suffix}.sqlite3'
+            with connection.cursor() as cursor:
+                # ATTACH/DETACH в SQLite невозможны внутри транзакции
+                cursor.execute('ATTACH DATABASE %s AS archive', [str(path)])
+                try:
+                    with transaction.atomic():
+                        cursor.execute(f'CREATE TABLE IF NOT EXISTS archive.{table} AS SELECT * FROM main.{table} WHERE 0')
+                        cursor.execute(f'INSERT INTO archive.{table} ({columns}) {select}', params)
+                        moved[suffix], _ = queryset.delete()
+                finally:
+                    cursor.execute('DETACH DATABASE archive')
+
+        elif connection.vendor == 'postgresql':
+            month_table = connection.ops.quote_name(f'{table}_{suffix}')
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(f'CREATE TABLE IF NOT EXISTS {month_table} (LIKE {table} INCLUDING ALL)')
+                cursor.execute(f'INSERT INTO {month_table} ({columns}) {select}', params)
+                moved[suffix], _ = queryset.delete()
+
+        else:
+            raise NotImplementedError(f'Перенос архива не поддерживается для {connection.vendor}')
+
+    return moved
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+from collections import Counter, deque
+
+from .metrics import percentile
+
+routing_logger = logging.getLogger('routing_log')
+
+
+class RoutingStats:
+    '''
+        Сколько обновлений ушло в каждый обработчик и сколько времени занял выбор обработчика
+    '''
+
+    def __init__(self, window: int = 10000):
+        self.lock = threading.Lock()
+        self.routes = Counter()
+        self.timings = deque(maxlen=window)
+
+    def record(self, route: str, elapsed: float):
+        with self.lock:
+            self.routes[route] += 1
+            self.timings.append(elapsed)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            timings = sorted(self.timings)
+            routes = dict(self.routes)
+
+        return {
+            'routes': routes,
+            'routing_p50_us': round(percentile(timings, 0.5) * 10 ** 6, 3),
+            'routing_p99_us': round(percentile(timings, 0.99) * 10 ** 6, 3),
+        }
+
+
+class Router:
+    '''
+        Таблица маршрутов входящих обновлений вместо цепочки фильтров telebot.
+        Обработчик выбирается поиском по словарю: команда, префикс callback_data до точки, текст кнопки,
+        затем состояние пользователя (одна проверка на сообщение) и тип содержимого
+    '''
+
+    def __init__(self, state_of):
+        # state_of(user_id, chat_id) - текущее состояние пользователя
+        self.state_of = state_of
+        self.commands = {}
+        self.callbacks = {}
+        self.texts = {}
+        self.states = {}
+        self.content_types = {}
+        self.stats = RoutingStats()
+
+    def register(self, table: dict, keys):
+        def decorator(handler):
+            for key in keys:
+                table[key] = handler
+            return handler
+        return decorator
+
+    def command(self, *names):
+        return self.register(self.commands, names)
+
+    def callback(self, *prefixes):
+        return self.register(self.callbacks, prefixes)
+
+    def text(self, *texts):
+        return self.register(self.texts, texts)
+
+    def state(self, *states):
+        '''
+            Обработчик текста пользователя в данном состоянии. Команды и кнопки меню срабатывают раньше
+        '''
+        return self.register(self.states, states)
+
+    def content(self, *content_types):
+        return self.register(self.content_types, content_types)
+
+    def resolve_message(self, message):
+        text = message.text
+        if text:
+            if text.startswith('/'):
+                handler = self.commands.get(text.split()[0][1:].split('@')[0])
+                if handler:
+                    return handler
+            handler = self.texts.get(text)
+            if handler:
+                return handler
+            if self.states:
+                handler = self.states.get(self.state_of(message.from_user.id, message.chat.id))
+                if handler:
+                    return handler
+        return self.content_types.get(message.content_type)
+
+    def resolve_callback(self, call):
+        return self.callbacks.get((call.data or '').split('.', 1)[0])
+
+    def dispatch(self, resolve, update):
+        started = time.perf_counter()
+        handler = resolve(update)
+        self.stats.record(handler.__name__ if handler else 'unrouted', time.perf_counter() - started)
+        if handler is None:
+            routing_logger.debug(f'Нет обработчика для обновления {update}')
+            return
+        return handler(update)
+
+    def dispatch_message(self, message):
+        return self.dispatch(self.resolve_message, message)
+
+    def dispatch_callback(self, call):
+        return self.dispatch(self.resolve_callback, call)
+
+    def install(self, bot):
+        '''
+            Регистрация в боте ровно двух обработчиков - для сообщений и для нажатий кнопок
+        '''
+        bot.register_message_handler(self.dispatch_message, content_types=list(self.content_types))
+        bot.register_callback_query_handler(self.dispatch_callback, func=None)
@@ -0,0 +1,149 @@
+import datetime
+import heapq
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from ..models import Reminder, Task, UserProfile
+
+scheduler_logger = logging.getLogger('scheduler_log')
+
+
+class Scheduler:
+    '''
+        Долгоживущий планировщик рассылки.
+        Держит в куче ближайшие моменты срабатывания и спит до ближайшего из них
+    '''
+
+    def __init__(self, send, cleanup=None, horizon: int = None, reload_interval: int = None, cleanup_interval: int = None):
+        self.send = send
+        self.cleanup = cleanup
+        self.horizon = datetime.timedelta(seconds=horizon or settings.SCHEDULER_HORIZON)
+        self.reload_interval = datetime.timedelta(seconds=reload_interval or settings.SCHEDULER_RELOAD_INTERVAL)
+        self.cleanup_interval = datetime.timedelta(seconds=cleanup_interval or settings.SCHEDULER_CLEANUP_INTERVAL)
+        self.stop_event = threading.Event()
+
+        self.heap = []
+        self.scheduled = set()
+        self.last_reminder_id = 0
+        self.last_task_id = 0
+        # Заблокировавшие бота на момент прошлой загрузки: их строки в кучу не попадают
+        self.blocked = set()
+        self.loaded_until = None
+        self.next_reload = None
+        self.next_cleanup = None
+
+    def push(self, fire_at: datetime.datetime, model: str, item_id: int):
+        entry = (fire_at, model, item_id)
+        if entry not in self.scheduled:
+            self.scheduled.add(entry)
+            heapq.heappush(self.heap, entry)
+
+    def push_rows(self, queryset, model: str, not_before: datetime.datetime = None) -> int:
+        last_id = 0
+        # Тот же отбор, что в collect_due: строки заблокировавших бота пользователей не отправляются
+        # и никогда не сдвигаются, поэтому будили бы планировщик каждые reload_interval
+        queryset = queryset.filter(next_fire_at__lte=self.loaded_until, user__is_blocked=False)
+        for item_id, next_fire_at in queryset.values_list('id', 'next_fire_at'):
+            if not_before:
+                next_fire_at = max(next_fire_at, not_before)
+            self.push(next_fire_at, model, item_id)
+            last_id = max(last_id, item_id)
+        return last_id
+
+    def blocked_users(self) -> set:
+        return set(UserProfile.objects.filter(is_blocked=True).values_list('user_id', flat=True))
+
+    def load(self, now: datetime.datetime):
+        '''
+            Полная загрузка окна [сейчас, сейчас + горизонт] одним диапазоном по next_fire_at
+        '''
+        self.heap = []
+        self.scheduled = set()
+        self.loaded_until = now + self.horizon
+        self.blocked = self.blocked_users()
+        self.push_rows(Reminder.objects.all(), 'reminder')
+        self.push_rows(Task.objects.all(), 'task')
+
+        self.last_reminder_id = Reminder.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        self.last_task_id = Task.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        scheduler_logger.info(f'Загружено {len(self.heap)} срабатываний до {self.loaded_until}')
+
+    def load_new(self):
+        '''
+            Догрузка созданных после прошлой загрузки строк, перенесённых задач
+            и строк пользователей, снова нажавших /start
+        '''
+        self.last_reminder_id = max(self.last_reminder_id, self.push_rows(Reminder.objects.filter(id__gt=self.last_reminder_id), 'reminder'))
+        self.last_task_id = max(self.last_task_id, self.push_rows(Task.objects.filter(id__gt=self.last_task_id), 'task'))
+        # Перенос меняет уже существующую строку, поэтому переносы смотрятся отдельно
+        self.push_rows(Task.objects.filter(next_fire_kind='transfer'), 'task')
+        # Разблокировка тоже не создаёт новых строк: готовые строки такого пользователя ждали бы полной загрузки
+        blocked = self.blocked_users()
+        unblocked = self.blocked - blocked
+        self.blocked = blocked
+        if unblocked:
+            self.push_rows(Reminder.objects.filter(user_id__in=unblocked), 'reminder')
+            self.push_rows(Task.objects.filter(user_id__in=unblocked), 'task')
+
+    def reload_fired(self, fired: list, now: datetime.datetime):
+        '''
+            После отправки у сработавших строк сдвигается next_fire_at - подхватываем новое значение.
+            Строки, которые так и остались готовыми (ошибка, заблокированный пользователь), повторяются не чаще reload_interval
+        '''
+        retry_at = now + self.reload_interval
+        self.push_rows(Reminder.objects.filter(id__in=[item_id for _, model, item_id in fired if model == 'reminder']), 'reminder', retry_at)
+        self.push_rows(Task.objects.filter(id__in=[item_id for _, model, item_id in fired if model == 'task']), 'task', retry_at)
+
+    def pop_due(self, now: datetime.datetime) -> list:
+        fired = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            self.scheduled.discard(entry)
+            fired.append(entry)
+        return fired
+
+    def tick(self, now: datetime.datetime) -> float:
+        '''
+            Один шаг цикла. Возвращает количество секунд до следующего пробуждения
+        '''
+        if self.loaded_until is None or now >= self.loaded_until - self.reload_interval:
+            self.load(now)
+            self.next_reload = now + self.reload_interval
+        elif now >= self.next_reload:
+            self.load_new()
+            self.next_reload = now + self.reload_interval
+
+        fired = self.pop_due(now)
+        if fired:
+            scheduler_logger.debug(f'Сработало {len(fired)}: {fired[:10]}')
+            # Источник истины - база, куча лишь говорит, когда проснуться
+            self.send()
+            self.reload_fired(fired, now)
+
+        if self.cleanup and (self.next_cleanup is None or now >= self.next_cleanup):
+            self.cleanup()
+            self.next_cleanup = now + self.cleanup_interval
+
+        wake_at = self.next_reload
+        if self.heap:
+            wake_at = min(wake_at, self.heap[0][0])
+        return max((wake_at - timezone.now()).total_seconds(), 0)
+
+    def run(self):
+        scheduler_logger.info('Планировщик запущен')
+        while not self.stop_event.is_set():
+            close_old_connections()
+            try:
+                delay = self.tick(timezone.now())
+            except Exception as e:
+                scheduler_logger.error(f'Ошибка в цикле планировщика: {e}')
+                delay = self.reload_interval.total_seconds()
+            self.stop_event.wait(delay)
+        scheduler_logger.info('Планировщик остановлен')
+
+    def stop(self):
+        self.stop_event.set()
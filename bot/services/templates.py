@@ -0,0 +1,105 @@
+import datetime
+import functools
+
+from django.utils import timezone
+from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Заголовки сообщений рассылки по видам (см. Outbox.KINDS) для нейтрального тона
+HEADLINES = {
+    'pre_reminder': "⏰ Предварительное напоминание ({lead})!",
+    'reminder': "🔔 Время пришло!",
+    'pre_task': "⏰ Предварительное напоминание для задачи ({lead})!",
+    'task': "🔔 Время пришло!",
+    'transfer': "🔔 Время пришло!",
+}
+
+# Замены заголовков для остальных тонов общения (UserProfile.tone)
+TONE_HEADLINES = {
+    'business': {
+        'pre_reminder': "⏰ Уведомление заранее ({lead}).",
+        'reminder': "🔔 Напоминание.",
+        'pre_task': "⏰ Уведомление о задаче заранее ({lead}).",
+        'task': "🔔 Срок задачи.",
+        'transfer': "🔔 Срок отложенной задачи.",
+    },
+    'friendly': {
+        'pre_reminder': "⏰ Напоминаю заранее ({lead})!",
+        'reminder': "🔔 Время пришло! 😊",
+        'pre_task': "⏰ Скоро задача ({lead})!",
+        'task': "🔔 Время пришло! 😊",
+        'transfer': "🔔 Время пришло! 😊",
+    },
+}
+
+# Последняя строка сообщения в зависимости от тона и обращения (UserProfile.addressing)
+CLOSINGS = {
+    ('friendly', 'ty'): "Не забудь 😉",
+    ('friendly', 'vy'): "Не забудьте 😉",
+    ('business', 'vy'): "Пожалуйста, не забудьте.",
+}
+
+REPEAT_SUFFIXES = {
+    ('daily', False): " 🔄 (повторится завтра)",
+    ('weekly', False): " 🔄 (повторится через неделю)",
+    ('daily', True): " 🔄",
+    ('weekly', True): " 🔄",
+}
+
+# Вид сообщения, для которого метка повторения выводится коротко
+SHORT_REPEAT_KINDS = {'pre_reminder'}
+
+# Подставляется вместо ID задачи при однократной сборке клавиатуры
+TASK_ID_PLACEHOLDER = '__TASK_ID__'
+
+
+def repeat_suffix(repeat_type: str, short: bool = False) -> str:
+    return REPEAT_SUFFIXES.get((repeat_type, short), "")
+
+
+@functools.lru_cache(maxsize=None)
+def message_template(kind: str, addressing: str = None, tone: str = None, repeat_type: str = None):
+    '''
+        Собранный шаблон сообщения для сочетания вида, обращения, тона и повторения.
+        Возвращает готовый к вызову str.format с полями text и lead
+    '''
+    headline = TONE_HEADLINES.get(tone, {}).get(kind, HEADLINES[kind])
+    template = f"{headline}{repeat_suffix(repeat_type, short=kind in SHORT_REPEAT_KINDS)}\n📝 {{text}}"
+    closing = CLOSINGS.get((tone, addressing))
+    if closing:
+        template += f"\n\n{closing}"
+    return template.format
+
+
+@functools.lru_cache(maxsize=None)
+def task_markup_parts() -> tuple:
+    '''
+        JSON клавиатуры задачи, собранный один раз и разрезанный по месту ID задачи
+    '''
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton(text="✅ Завершить!", callback_data=f"t.finish|{TASK_ID_PLACEHOLDER}"))
+    markup.add(InlineKeyboardButton(text="⏳ Отложить", callback_data=f"t.put_off|{TASK_ID_PLACEHOLDER}"))
+    markup.add(InlineKeyboardButton(text="❌ Удалить", callback_data=f"t.remove|{TASK_ID_PLACEHOLDER}"))
+    return tuple(markup.to_json().split(TASK_ID_PLACEHOLDER))
+
+
+def task_markup(task_id: int) -> str:
+    return str(task_id).join(task_markup_parts())
+
+
+def lead_text(item, now: datetime.datetime = None) -> str:
+    '''
+        Сколько осталось до события на момент отправки. Сохранённый интервал не подходит:
+        элемент, созданный позже времени предварительного напоминания, получает его сразу
+    '''
+    now = now or timezone.now()
+    minutes = max(round((item.reminder_time - now).total_seconds() / 60), 1)
+    return f"через {minutes} мин"
+
+
+def render_message(kind: str, item, now: datetime.datetime = None) -> str:
+    '''
+        Текст сообщения рассылки для напоминания или задачи. Профиль пользователя должен быть уже загружен (select_related)
+    '''
+    user = item.user
+    render = message_template(kind, user.addressing, user.tone, item.repeat_type)
+    return render(text=item.text, lead=lead_text(item, now) if kind in ('pre_reminder', 'pre_task') else '')
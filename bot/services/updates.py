@@ -0,0 +1,410 @@
+import datetime
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections
+from django.db.models import Subquery
+from django.utils import timezone
+from telebot.types import Update
+
+from ..models import IncomingUpdate, UpdateWatermark
+from .metrics import percentile
+
+updates_logger = logging.getLogger('updates_log')
+
+
+class QueueFull(Exception):
+    '''
+        Очередь входящих обновлений заполнена, обновление не принято
+    '''
+
+
+class UpdateStats:
+    '''
+        Счётчики приёма и обработки входящих обновлений.
+        wait - время в очереди, handle - время работы обработчиков
+    '''
+
+    def __init__(self, window: int = 10000):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.waits = deque(maxlen=window)
+        self.handles = deque(maxlen=window)
+
+    def record_accepted(self, depth: int):
+        with self.lock:
+            self.accepted += 1
+            self.max_depth = max(self.max_depth, depth)
+
+    def record_rejected(self):
+        with self.lock:
+            self.rejected += 1
+
+    def record_processed(self, wait: float, handle: float, failed: bool = False):
+        with self.lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.processed += 1
+            self.waits.append(wait)
+            self.handles.append(handle)
+
+    def snapshot(self, depth: int = 0) -> dict:
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            waits = sorted(self.waits)
+            handles = sorted(self.handles)
+            counters = dict(accepted=self.accepted, rejected=self.rejected, processed=self.processed, failed=self.failed, max_depth=self.max_depth)
+
+        return {
+            **counters,
+            'depth': depth,
+            'elapsed_s': round(elapsed, 3),
+            'throughput': round((counters['processed'] + counters['failed']) / elapsed, 3) if elapsed else 0,
+            'wait_p50_ms': round(percentile(waits, 0.5) * 1000, 3),
+            'wait_p99_ms': round(percentile(waits, 0.99) * 1000, 3),
+            'handle_p50_ms': round(percentile(handles, 0.5) * 1000, 3),
+            'handle_p99_ms': round(percentile(handles, 0.99) * 1000, 3),
+        }
+
+
+class UpdateDeduplicator:
+    '''
+        Отсев повторно доставленных обновлений (Telegram повторяет обновление, если не дождался ответа).
+        Последние window номеров хранятся в памяти, наибольший принятый номер периодически сохраняется в базе.
+        Номер, отстающий от наибольшего больше чем на window, считается старым повтором, в том числе сразу
+        после перезапуска. Ближе к отметке решает только память: такое обновление могло прийти не по порядку
+        или быть принято другим процессом, и отбрасывать его по одной отметке нельзя
+    '''
+
+    def __init__(self, name: str = 'updates', window: int = None, flush_interval: float = None, clock=time.monotonic):
+        self.name = name
+        self.window = window or settings.UPDATE_DEDUP_WINDOW
+        self.flush_interval = settings.UPDATE_WATERMARK_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.seen = set()
+        self.loaded = False
+        self.high_water = 0
+        self.flushed = 0
+        self.flushed_at = clock()
+        self.duplicates = 0
+
+    def load(self):
+        self.high_water = self.flushed = UpdateWatermark.objects.filter(name=self.name).values_list('update_id', flat=True).first() or 0
+        self.loaded = True
+
+    @property
+    def floor(self) -> int:
+        '''
+            Номера не больше floor - старые повторы
+        '''
+        return self.high_water - self.window
+
+    def accept(self, update_id: int) -> bool:
+        '''
+            True, если обновление новое. Повторы считаются в duplicates
+        '''
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if update_id <= self.floor or update_id in self.seen:
+                self.duplicates += 1
+                return False
+            self.seen.add(update_id)
+            self.recent.append(update_id)
+            if len(self.recent) > self.window:
+                self.seen.discard(self.recent.popleft())
+            self.high_water = max(self.high_water, update_id)
+            due = self.clock() - self.flushed_at >= self.flush_interval
+        if due:
+            self.flush()
+        return True
+
+    def record_duplicate(self):
+        with self.lock:
+            self.duplicates += 1
+
+    def flush(self):
+        '''
+            Сохранение наибольшего принятого номера. Отметка только растёт, даже если пишут несколько процессов
+        '''
+        with self.lock:
+            high_water = self.high_water
+            self.flushed_at = self.clock()
+            if high_water <= self.flushed:
+                return
+            self.flushed = high_water
+        if not UpdateWatermark.objects.filter(name=self.name, update_id__lt=high_water).update(update_id=high_water):
+            UpdateWatermark.objects.get_or_create(name=self.name, defaults={'update_id': high_water})
+
+
+def update_chat_id(update) -> int:
+    '''
+        Чат, к которому относится обновление. Обновления без чата попадают в один общий поток
+    '''
+    message = getattr(update, 'message', None) or getattr(update, 'edited_message', None)
+    if message is not None:
+        return message.chat.id
+    call = getattr(update, 'callback_query', None)
+    if call is not None:
+        return call.message.chat.id if call.message else call.from_user.id
+    return 0
+
+
+class UpdateExecutor:
+    '''
+        Пул потоков для обработки входящих обновлений.
+        Вебхук только кладёт обновление в ограниченную очередь и сразу отвечает,
+        обработчики (LLM, распознавание голоса) работают в потоках пула.
+        Обновления распределяются по потокам по chat.id: сообщения одного пользователя обрабатываются
+        строго по порядку, разные пользователи - параллельно и не ждут чужого распознавания голоса.
+        Telegram не присылает повторно обновление, на которое получил 200, поэтому при durable=True
+        принятое сначала записывается в IncomingUpdate, а после обработки отмечается обработанным
+    '''
+
+    def __init__(self, handle, workers: int = None, queue_size: int = None, dedup: UpdateDeduplicator = None,
+                 durable: bool = False):
+        self.handle = handle
+        self.dedup = dedup
+        self.durable = durable
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{id(self)}'
+        self.stats = UpdateStats()
+        self.closed = threading.Event()
+        # Сохранённые обновления, которые этот процесс держит в очереди или обрабатывает: их аренда продлевается
+        self.held = set()
+        self.held_lock = threading.Lock()
+        workers = workers or settings.UPDATE_WORKERS
+        # Общий размер очереди делится между потоками, у каждого потока своя очередь
+        shard_size = max((queue_size or settings.UPDATE_QUEUE_SIZE) // workers, 1)
+        self.queues = [queue.Queue(maxsize=shard_size) for _ in range(workers)]
+        # Потоки не фоновые: при штатном завершении процесса они дорабатывают свои очереди
+        self.threads = [
+            threading.Thread(target=self.worker, args=(shard,), name=f'updates-{i}')
+            for i, shard in enumerate(self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+        if durable:
+            threading.Thread(target=self.recovery, name='updates-recovery', daemon=True).start()
+
+    def shard(self, update) -> queue.Queue:
+        return self.queues[update_chat_id(update) % len(self.queues)]
+
+    def depth(self) -> int:
+        return sum(shard.qsize() for shard in self.queues)
+
+    def lease_until(self) -> datetime.datetime:
+        return timezone.now() + datetime.timedelta(seconds=settings.UPDATE_LEASE_SECONDS)
+
+    def hold(self, update_id: int):
+        if self.durable:
+            with self.held_lock:
+                self.held.add(update_id)
+
+    def release(self, update_id: int):
+        if self.durable:
+            with self.held_lock:
+                self.held.discard(update_id)
+
+    def held_ids(self) -> list:
+        with self.held_lock:
+            return list(self.held)
+
+    def submit(self, update, payload: str = None):
+        '''
+            Ставит обновление в очередь его чата без ожидания. Если очередь заполнена - QueueFull:
+            вебхук отвечает ошибкой, и Telegram повторит обновление позже.
+            payload - исходный JSON обновления, обязателен при durable=True: он сохраняется в базе
+        '''
+        shard = self.shard(update)
+        if self.durable:
+            if payload is None:
+                raise ValueError(f'Для обновления {update.update_id} не передан исходный JSON')
+            try:
+                IncomingUpdate.objects.create(update_id=update.update_id, payload=payload,
+                                              lease_owner=self.owner, lease_until=self.lease_until())
+            except IntegrityError:
+                # Повтор: обновление уже принято - ждёт обработки или обработано, возможно другим процессом
+                if self.dedup:
+                    self.dedup.record_duplicate()
+                return
+        self.hold(update.update_id)
+        try:
+            shard.put_nowait((time.monotonic(), update, False))
+        except queue.Full:
+            self.release(update.update_id)
+            if self.durable:
+                IncomingUpdate.objects.filter(update_id=update.update_id).delete()
+            self.reject(shard, update)
+        self.stats.record_accepted(self.depth())
+
+    def reject(self, shard: queue.Queue, update):
+        self.stats.record_rejected()
+        updates_logger.warning(f'Очередь обновлений заполнена ({shard.maxsize}), обновление {update.update_id} отклонено')
+        raise QueueFull(update.update_id)
+
+    def renew(self) -> int:
+        '''
+            Продление аренды всего, что процесс ещё держит: долгая очередь или медленный обработчик
+            не должны отдать обновление на повторную обработку
+        '''
+        held = self.held_ids()
+        if not held:
+            return 0
+        return IncomingUpdate.objects.filter(update_id__in=held, processed_at=None).update(lease_owner=self.owner, lease_until=self.lease_until())
+
+    def recover(self, limit: int = None) -> int:
+        '''
+            Берёт в аренду сохранённые обновления с истёкшей арендой (процесс, принявший их, завершился)
+            и ставит в очереди. Возвращает количество подобранных обновлений
+        '''
+        limit = limit or max(shard.maxsize for shard in self.queues)
+        now = timezone.now()
+        lease_until = self.lease_until()
+        # Своё, что ещё в очереди или в работе, не подбирается, даже если аренда не успела продлиться
+        available = IncomingUpdate.objects.filter(processed_at=None, lease_until__lte=now).exclude(update_id__in=self.held_ids())
+        expired = available.order_by('update_id').values('update_id')[:limit]
+        # Условие повторяется во внешнем UPDATE, чтобы не перехватить строку, занятую другим процессом
+        if not available.filter(update_id__in=Subquery(expired)).update(lease_owner=self.owner, lease_until=lease_until):
+            return 0
+
+        recovered = 0
+        rows = IncomingUpdate.objects.filter(processed_at=None, lease_owner=self.owner, lease_until=lease_until).exclude(update_id__in=self.held_ids()).order_by('update_id')
+        for row in rows:
+            try:
+                update = Update.de_json(row.payload)
+            except (ValueError, KeyError, TypeError) as e:
+                updates_logger.error(f'Не удалось разобрать сохранённое обновление {row.update_id}: {e}')
+                IncomingUpdate.objects.filter(update_id=row.update_id).update(processed_at=timezone.now())
+                continue
+            self.hold(row.update_id)
+            try:
+                self.shard(update).put_nowait((time.monotonic(), update, True))
+            except queue.Full:
+                # Места нет: аренда снимается, обновление подберётся в следующий раз
+                self.release(row.update_id)
+                IncomingUpdate.objects.filter(update_id=row.update_id, lease_owner=self.owner).update(lease_until=now)
+                continue
+            self.stats.record_accepted(self.depth())
+            recovered += 1
+        updates_logger.info(f'Подобрано необработанных обновлений: {recovered}')
+        return recovered
+
+    def prune(self) -> int:
+        '''
+            Удаление отметок обработанных обновлений старше UPDATE_PROCESSED_KEEP_HOURS
+        '''
+        before = timezone.now() - datetime.timedelta(hours=settings.UPDATE_PROCESSED_KEEP_HOURS)
+        deleted, _ = IncomingUpdate.objects.filter(processed_at__lte=before).delete()
+        return deleted
+
+    def recovery(self):
+        while not self.closed.is_set():
+            try:
+                self.renew()
+                self.recover()
+                self.prune()
+            except Exception as e:
+                updates_logger.error(f'Ошибка восстановления очереди обновлений: {e}')
+            finally:
+                close_old_connections()
+            self.closed.wait(settings.UPDATE_RECOVERY_INTERVAL)
+
+    def snapshot(self) -> dict:
+        snapshot = self.stats.snapshot(depth=self.depth())
+        snapshot['duplicates'] = self.dedup.duplicates if self.dedup else 0
+        if self.durable:
+            snapshot['stored'] = IncomingUpdate.objects.filter(processed_at=None).count()
+        return snapshot
+
+    def join(self):
+        '''
+            Ожидание обработки всех принятых обновлений
+        '''
+        for shard in self.queues:
+            shard.join()
+
+    def close(self):
+        '''
+            Останавливает потоки после того, как очереди будут разобраны
+        '''
+        self.closed.set()
+        for shard in self.queues:
+            shard.put(None)
+        if self.dedup:
+            for thread in self.threads:
+                thread.join()
+            self.dedup.flush()
+
+    def worker(self, shard: queue.Queue):
+        while True:
+            try:
+                job = shard.get(timeout=1)
+            except queue.Empty:
+                # Основной поток завершился, а очередь разобрана: выходим, не задерживая остановку процесса
+                if not threading.main_thread().is_alive():
+                    if self.dedup:
+                        self.dedup.flush()
+                    return
+                continue
+            if job is None:
+                shard.task_done()
+                return
+            queued_at, update, recovered = job
+            # Повтор отбрасывается до обработчиков: без второго вызова LLM и второй записи в базу.
+            # Подобранное из базы не проверяется - его номер уже учтён процессом, который его принял
+            if self.dedup and not recovered and not self.dedup.accept(update.update_id):
+                self.finish(update)
+                shard.task_done()
+                continue
+            started = time.monotonic()
+            failed = False
+            try:
+                self.handle(update)
+            except Exception as e:
+                failed = True
+                updates_logger.error(f'Ошибка обработки обновления {update.update_id}: {e}')
+            finally:
+                self.finish(update)
+                # Соединение с базой у каждого потока своё, закрываем устаревшие как после запроса
+                close_old_connections()
+                self.stats.record_processed(started - queued_at, time.monotonic() - started, failed=failed)
+                shard.task_done()
+
+    def finish(self, update):
+        if not self.durable:
+            return
+        try:
+            IncomingUpdate.objects.filter(update_id=update.update_id).update(processed_at=timezone.now())
+        except Exception as e:
+            updates_logger.error(f'Не удалось отметить обработанное обновление {update.update_id}: {e}')
+        finally:
+            self.release(update.update_id)
+
+
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_update_executor(handle) -> UpdateExecutor:
+    '''
+        Общий пул процесса, создаётся при первом обновлении
+    '''
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = UpdateExecutor(handle, dedup=UpdateDeduplicator(), durable=True)
+        return executor
@@ -1,3 +1,947 @@
-from django.test import TestCase
+import datetime
+import json
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+from concurrent.futures import Future
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from telebot import TeleBot, apihelper
+from telebot.apihelper import ApiTelegramException
+from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup, Update
+
+from .models import DeliveryHistory, IncomingUpdate, Outbox, Reminder, Task, UpdateWatermark, UserProfile
+from .handlers import common, reminder
+from .services.delivery import CircuitBreaker, DeliveryPool, TokenBucket
+from .benchmarks.fake_api import FakeBotAPI, make_server
+from .benchmarks.fixtures import create_population
+from .benchmarks.scenarios import bench_workers
+from .services import identity
+from .services.dryrun import replay
+from .services.due import collect_due, mark_sent
+from .services.metrics import TickMetrics
+from .services.outbox import claim_batch, drain_outbox, enqueue_due
+from .services.parser import parse_reminder_time
+from .services.polling import Poller
+from .services.retention import purge_finished, rollover_history
+from .services.scheduler import Scheduler
+from .services.templates import render_message, task_markup
+from .services.updates import UpdateDeduplicator, UpdateExecutor
+
+
+def create_user(user_id: int) -> UserProfile:
+    return UserProfile.objects.create(user_id=user_id, username=f'user_{user_id}', addressing='ty', tone='neutral', timezone='+3')
+
+
+def create_reminder(user_id: int, reminder_time: datetime.datetime, **kwargs) -> Reminder:
+    fields = dict(
+        user_id=user_id,
+        text='Напоминание',
+        reminder_time=reminder_time,
+        pre_reminder_time=reminder_time - datetime.timedelta(minutes=15),
+        is_pre_reminder_sent=False,
+        is_main_reminder_sent=False,
+        created_at=timezone.now(),
+    )
+    fields.update(kwargs)
+    return Reminder.objects.create(**fields)
+
+
+def create_task(user_id: int, reminder_time: datetime.datetime, **kwargs) -> Task:
+    fields = dict(
+        user_id=user_id,
+        text='Задача',
+        reminder_time=reminder_time,
+        pre_reminder_time=reminder_time - datetime.timedelta(minutes=15),
+        is_completed=False,
+        is_transfered=False,
+        is_pre_reminder_sent=False,
+        is_main_reminder_sent=False,
+        created_at=timezone.now(),
+    )
+    fields.update(kwargs)
+    return Task.objects.create(**fields)
+
+
+def count_queries(func) -> int:
+    with CaptureQueriesContext(connection) as context:
+        func()
+    return len(context.captured_queries)
+
+
+@override_settings(DELIVERY_GLOBAL_RATE=1000, DELIVERY_CHAT_RATE=1000)
+class QueryCountTests(TestCase):
+    '''
+        Количество запросов не должно зависеть от числа элементов (N+1)
+    '''
+
+    def fill(self, users: int):
+        now = timezone.now()
+        for user_id in range(1, users + 1):
+            create_user(user_id)
+            create_reminder(user_id, now - datetime.timedelta(minutes=20))
+            create_task(user_id, now - datetime.timedelta(minutes=20))
+
+    def send_reminders_queries(self, users: int) -> int:
+        self.fill(users)
+        with mock.patch.object(common, 'bot'):
+            return count_queries(common.send_reminders)
+
+    def test_send_reminders_is_constant(self):
+        small = self.send_reminders_queries(1)
+        Reminder.objects.all().delete()
+        Task.objects.all().delete()
+        UserProfile.objects.all().delete()
+        self.assertEqual(self.send_reminders_queries(10), small)
+
+    def test_list_reminders_is_constant(self):
+        create_user(1)
+        now = timezone.now()
+        message = SimpleNamespace(from_user=SimpleNamespace(id=1), chat=SimpleNamespace(id=1))
+        bot = mock.Mock()
+
+        create_reminder(1, now + datetime.timedelta(hours=1))
+        create_reminder(1, now + datetime.timedelta(hours=1), repeat_type='daily')
+        create_task(1, now + datetime.timedelta(hours=1))
+        create_task(1, now + datetime.timedelta(hours=1), repeat_type='weekly')
+        small = count_queries(lambda: reminder.list_reminders(message, bot))
+
+        for _ in range(10):
+            create_reminder(1, now + datetime.timedelta(hours=2))
+            create_reminder(1, now + datetime.timedelta(hours=2), repeat_type='daily')
+            create_task(1, now + datetime.timedelta(hours=2))
+            create_task(1, now + datetime.timedelta(hours=2), repeat_type='weekly')
+        self.assertEqual(count_queries(lambda: reminder.list_reminders(message, bot)), small)
+
+
+class DeliveryPoolTests(TestCase):
+    '''
+        Ограничение скорости и повторы в пуле отправки
+    '''
+
+    def test_token_bucket_spacing(self):
+        now = [0.0]
+        bucket = TokenBucket(rate=2, capacity=1, clock=lambda: now[0])
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.5)
+        self.assertAlmostEqual(bucket.reserve(), 1.0)
+        now[0] = 10
+        self.assertEqual(bucket.reserve(), 0)
+
+    def test_global_rate_is_shared_between_processes(self):
+        pool = DeliveryPool(mock.Mock(), workers=1, processes=3)
+        pool.close()
+        self.assertEqual(pool.global_bucket.rate, settings.DELIVERY_GLOBAL_RATE / 3)
+
+    def test_chat_messages_are_spaced(self):
+        bot = mock.Mock()
+        sent_at = []
+        bot.send_message.side_effect = lambda **kwargs: sent_at.append(time.monotonic())
+        pool = DeliveryPool(bot, workers=4, global_rate=1000, chat_rate=20)
+        futures = [pool.submit(chat_id=1, text=str(i)) for i in range(5)]
+        for future in futures:
+            future.result(timeout=5)
+        pool.close()
+        gaps = [b - a for a, b in zip(sent_at, sent_at[1:])]
+        self.assertTrue(all(gap >= 0.04 for gap in gaps), gaps)
+
+    def test_retry_after_is_honoured(self):
+        error = ApiTelegramException('sendMessage', None, {
+            'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 0.2},
+        })
+        bot = mock.Mock()
+        bot.send_message.side_effect = [error, 'ok']
+        pool = DeliveryPool(bot, workers=1, global_rate=1000, chat_rate=1000)
+        started = time.monotonic()
+        self.assertEqual(pool.submit(chat_id=1, text='a').result(timeout=5), 'ok')
+        pool.close()
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(pool.stats.snapshot()['retries'], 1)
+        self.assertEqual(pool.stats.snapshot()['sent'], 1)
+
+
+class FakePool:
+    '''
+        Пул отправки, который сразу выполняет отправку в текущем потоке
+    '''
+
+    def __init__(self, error: Exception = None):
+        self.error = error
+        self.sent = []
+        self.breaker = CircuitBreaker(threshold=100, cooldown=60)
+
+    def submit(self, chat_id, text, **kwargs):
+        future = Future()
+        if self.error:
+            future.set_exception(self.error)
+        else:
+            self.sent.append((chat_id, text))
+            future.set_result(None)
+        return future
+
+
+class OutboxTests(TestCase):
+    '''
+        Очередь исходящих сообщений
+    '''
+
+    def setUp(self):
+        create_user(1)
+        create_reminder(1, timezone.now() - datetime.timedelta(minutes=20))
+        create_reminder(1, timezone.now() - datetime.timedelta(minutes=20))
+
+    def test_enqueue_is_idempotent(self):
+        self.assertEqual(enqueue_due(), 2)
+        self.assertEqual(enqueue_due(), 0)
+        self.assertEqual(Outbox.objects.count(), 2)
+
+    def test_failed_delivery_resumes_from_outbox(self):
+        enqueue_due()
+        self.assertEqual(drain_outbox(FakePool(error=ConnectionError('нет сети')))['failed'], 2)
+        self.assertEqual(Outbox.objects.filter(status='pending', attempts=1).count(), 2)
+
+        # До конца паузы повтор не берётся
+        pool = FakePool()
+        self.assertEqual(drain_outbox(pool)['sent'], 0)
+        later = timezone.now() + datetime.timedelta(seconds=settings.DELIVERY_BACKOFF_BASE + 1)
+        self.assertEqual(drain_outbox(pool, now=later)['sent'], 2)
+        self.assertEqual(len(pool.sent), 2)
+        self.assertEqual(Outbox.objects.filter(status='sent').count(), 2)
+        self.assertEqual(drain_outbox(pool)['sent'], 0)
+
+    def test_tick_metrics_are_recorded(self):
+        metrics = TickMetrics()
+        enqueue_due(metrics=metrics)
+        drain_outbox(FakePool(), metrics=metrics)
+        tick = metrics.save()
+        # Предварительные пропущены: основное время уже наступило
+        self.assertEqual((tick.due['reminders'], tick.due['pre_reminders'], tick.enqueued, tick.sent), (2, 0, 2, 2))
+        # Оба опоздали на 20 минут
+        self.assertEqual(tick.lateness_histogram['1800'], 2)
+        self.assertEqual(tick.lateness_histogram['600'], 0)
+        self.assertGreaterEqual(tick.lateness_p99_s, 20 * 60)
+
+    def test_workers_claim_disjoint_batches(self):
+        enqueue_due()
+        now = timezone.now()
+        first = claim_batch(now, limit=1, worker='a')
+        second = claim_batch(now, limit=1, worker='b')
+        self.assertEqual(len(first), 1)
+        self.assertEqual(len(second), 1)
+        self.assertNotEqual(first[0].id, second[0].id)
+        self.assertEqual(claim_batch(now, worker='c'), [])
+        # После истечения аренды сообщение снова доступно
+        later = now + datetime.timedelta(seconds=settings.OUTBOX_LEASE_SECONDS + 1)
+        self.assertEqual(len(claim_batch(later, worker='c')), 2)
+
+
+class DigestTests(TestCase):
+    '''
+        Объединение нескольких сообщений одному пользователю в сводку
+    '''
+
+    def test_burst_is_sent_as_one_catch_up_digest(self):
+        create_user(1)
+        create_user(2)
+        past = timezone.now() - datetime.timedelta(hours=2)
+        for _ in range(3):
+            create_reminder(1, past)
+        task = create_task(1, past)
+        create_reminder(2, past)
+
+        enqueue_due()
+        pool = FakePool()
+        self.assertEqual(drain_outbox(pool), {'sent': 5, 'failed': 0})
+        # У пользователя 1 в сводку попадают 3 напоминания, задача с кнопками идёт отдельно.
+        # У пользователя 2 сообщений не больше порога - они уходят как есть
+        self.assertEqual(len(pool.sent), 3)
+        digest = [text for chat_id, text in pool.sent if chat_id == 1 and text.startswith('⌛')]
+        self.assertEqual(len(digest), 1)
+        self.assertEqual(digest[0].count('🔔 Время пришло!'), 3)
+        self.assertIn('Было запланировано 2 ч', digest[0])
+        self.assertIn((1, f'🔔 Время пришло!\n📝 {task.text}'), pool.sent)
+
+    def test_long_digest_is_split(self):
+        create_user(1)
+        now = timezone.now()
+        for _ in range(4):
+            create_reminder(1, now - datetime.timedelta(minutes=1), text='x' * 3000, is_pre_reminder_sent=True)
+        enqueue_due()
+        pool = FakePool()
+        drain_outbox(pool)
+        self.assertEqual(len(pool.sent), 4)
+        self.assertTrue(all(text.startswith('📋') and len(text) <= settings.MESSAGE_MAX_LENGTH for _, text in pool.sent))
+
+
+class TemplateTests(TestCase):
+    '''
+        Шаблоны сообщений рассылки
+    '''
+
+    def test_task_markup_matches_keyboard(self):
+        markup = InlineKeyboardMarkup()
+        markup.add(InlineKeyboardButton(text="✅ Завершить!", callback_data="t.finish|42"))
+        markup.add(InlineKeyboardButton(text="⏳ Отложить", callback_data="t.put_off|42"))
+        markup.add(InlineKeyboardButton(text="❌ Удалить", callback_data="t.remove|42"))
+        self.assertEqual(task_markup(42), markup.to_json())
+
+    def test_variants_follow_user_settings(self):
+        now = timezone.now()
+        item = Reminder(user=UserProfile(addressing='vy', tone='friendly'), text='{зарядка}', reminder_time=now,
+                        pre_reminder_time=now - datetime.timedelta(minutes=30), repeat_type='daily')
+        self.assertEqual(render_message('pre_reminder', item, now=item.pre_reminder_time), "⏰ Напоминаю заранее (через 30 мин)! 🔄\n📝 {зарядка}\n\nНе забудьте 😉")
+        # Создано позже времени предварительного напоминания: в тексте - реально оставшееся время
+        self.assertIn("(через 5 мин)", render_message('pre_reminder', item, now=now - datetime.timedelta(minutes=5)))
+        item.user = UserProfile(addressing='ty', tone='neutral')
+        self.assertEqual(render_message('reminder', item), "🔔 Время пришло! 🔄 (повторится завтра)\n📝 {зарядка}")
+
+
+class FailureIsolationTests(TestCase):
+    '''
+        Разбор ошибок отправки по отдельным сообщениям
+    '''
+
+    def test_blocked_user_is_flagged_and_skipped(self):
+        create_user(1)
+        create_user(2)
+        now = timezone.now()
+        create_reminder(1, now - datetime.timedelta(minutes=1))
+        create_reminder(2, now - datetime.timedelta(minutes=1))
+        forbidden = ApiTelegramException('sendMessage', None, {'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'})
+
+        bot = mock.Mock()
+        bot.send_message.side_effect = lambda chat_id, **kwargs: (_ for _ in ()).throw(forbidden) if chat_id == 1 else None
+        pool = DeliveryPool(bot, workers=1, global_rate=1000, chat_rate=1000)
+        enqueue_due()
+        counters = drain_outbox(pool)
+        pool.close()
+
+        self.assertEqual(counters, {'sent': 1, 'failed': 1})
+        self.assertTrue(UserProfile.objects.get(user_id=1).is_blocked)
+        self.assertEqual(Outbox.objects.get(chat_id=1).status, 'failed')
+        create_reminder(1, now - datetime.timedelta(minutes=1))
+        self.assertEqual(enqueue_due(), 0)
+
+    def test_circuit_breaker_opens_and_recovers(self):
+        now = [0.0]
+        breaker = CircuitBreaker(threshold=2, cooldown=10, clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        now[0] = 11
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+
+
+class NextFireTests(TestCase):
+    '''
+        Поддержание next_fire_at при создании, отправке и переносе
+    '''
+
+    def setUp(self):
+        create_user(1)
+
+    def test_next_fire_follows_delivery(self):
+        now = timezone.now()
+        item = create_reminder(1, now + datetime.timedelta(minutes=10))
+        self.assertEqual((item.next_fire_at, item.next_fire_kind), (item.pre_reminder_time, 'pre'))
+
+        mark_sent(collect_due(now))
+        item.refresh_from_db()
+        self.assertTrue(item.is_pre_reminder_sent)
+        self.assertEqual((item.next_fire_at, item.next_fire_kind), (item.reminder_time, 'main'))
+        self.assertEqual(collect_due(now).reminders + collect_due(now).pre_reminders, [])
+
+    def test_pre_reminder_uses_user_lead_and_is_skipped_when_late(self):
+        UserProfile.objects.filter(user_id=1).update(pre_reminder_minutes=40)
+        reminder_time, pre_reminder_time, _, _ = parse_reminder_time('через 30 минут позвонить', user=UserProfile.objects.get(user_id=1))
+        self.assertEqual(reminder_time - pre_reminder_time, datetime.timedelta(minutes=40))
+
+        now = timezone.now()
+        late = create_reminder(1, now - datetime.timedelta(minutes=1))
+        due = collect_due(now)
+        self.assertEqual((due.pre_reminders, due.reminders), ([], [late]))
+
+    def test_put_off_schedules_transfer(self):
+        task = create_task(1, timezone.now() - datetime.timedelta(minutes=20), is_pre_reminder_sent=True, is_main_reminder_sent=True)
+        self.assertIsNone(task.next_fire_at)
+        call = SimpleNamespace(id='1', data=f't.put_off|{task.id}', message=SimpleNamespace(chat=SimpleNamespace(id=1), message_id=1))
+        common.task_sets(call, mock.Mock())
+        task.refresh_from_db()
+        self.assertEqual(task.next_fire_kind, 'transfer')
+        self.assertEqual(task.next_fire_at, task.transfer_time)
+
+        common.task_sets(SimpleNamespace(id='2', data=f't.finish|{task.id}', message=call.message), mock.Mock())
+        task.refresh_from_db()
+        self.assertIsNone(task.next_fire_at)
+
+    def test_recurring_task_buttons_act_on_current_occurrence(self):
+        now = timezone.now()
+        task = create_task(1, now - datetime.timedelta(minutes=1), is_pre_reminder_sent=True, repeat_type='daily')
+        mark_sent(collect_due(now))
+        task.refresh_from_db()
+        next_time = task.reminder_time
+        self.assertGreater(next_time, now + datetime.timedelta(hours=23))
+
+        # Перенос - на полчаса от нажатия, а не от следующего повторения
+        call = SimpleNamespace(id='1', data=f't.put_off|{task.id}', message=SimpleNamespace(chat=SimpleNamespace(id=1), message_id=1))
+        common.task_sets(call, mock.Mock())
+        task.refresh_from_db()
+        self.assertEqual(task.next_fire_kind, 'transfer')
+        self.assertLess(abs(task.transfer_time - now - datetime.timedelta(minutes=30)), datetime.timedelta(minutes=1))
+
+        # Завершение отмечает только текущее повторение: перенос снят, серия продолжается
+        common.task_sets(SimpleNamespace(id='2', data=f't.finish|{task.id}', message=call.message), mock.Mock())
+        task.refresh_from_db()
+        self.assertFalse(task.is_completed)
+        self.assertEqual((task.next_fire_at, task.next_fire_kind), (task.pre_reminder_time, 'pre'))
+        self.assertEqual(task.reminder_time, next_time)
+        purge_finished(pause=0)
+        self.assertTrue(Task.objects.filter(id=task.id).exists())
+
+    def test_concurrent_change_is_not_overwritten(self):
+        now = timezone.now()
+        finished = create_task(1, now - datetime.timedelta(minutes=1), is_pre_reminder_sent=True)
+        put_off = create_task(1, now - datetime.timedelta(hours=1), is_pre_reminder_sent=True, is_main_reminder_sent=True,
+                              is_transfered=True, transfer_time=now - datetime.timedelta(minutes=1))
+        untouched = create_reminder(1, now - datetime.timedelta(minutes=1), is_pre_reminder_sent=True)
+
+        def collect_and_change(now):
+            due = collect_due(now)
+            # Пользователь нажал кнопки между выборкой и отметкой
+            task = Task.objects.get(id=finished.id)
+            task.is_completed = True
+            task.save()
+            task = Task.objects.get(id=put_off.id)
+            task.is_transfered, task.transfer_time = True, now + datetime.timedelta(minutes=30)
+            task.save()
+            return due
+
+        with mock.patch('bot.services.outbox.collect_due', side_effect=collect_and_change):
+            self.assertEqual(enqueue_due(now), 1)
+        self.assertEqual(list(Outbox.objects.values_list('kind', 'item_id')), [('reminder', untouched.id)])
+        finished.refresh_from_db()
+        put_off.refresh_from_db()
+        self.assertEqual((finished.is_completed, finished.next_fire_at), (True, None))
+        self.assertEqual((put_off.is_transfered, put_off.next_fire_kind), (True, 'transfer'))
+        self.assertEqual(put_off.next_fire_at, now + datetime.timedelta(minutes=30))
+
+    def test_recurring_item_is_rearmed(self):
+        now = timezone.now()
+        # Простой в трое суток: пропущенные повторения не рассылаются
+        reminder_time = now - datetime.timedelta(days=3, minutes=20)
+        item = create_reminder(1, reminder_time, repeat_type='daily', repeat_time=reminder_time + datetime.timedelta(days=1))
+        task = create_task(1, reminder_time, repeat_type='weekly', is_transfered=True, transfer_time=now - datetime.timedelta(minutes=1))
+
+        self.assertEqual(enqueue_due(now), 3)
+        item.refresh_from_db()
+        task.refresh_from_db()
+        self.assertEqual(Reminder.objects.count(), 1)
+        self.assertEqual(item.reminder_time, reminder_time + datetime.timedelta(days=4))
+        self.assertEqual(item.reminder_time - item.pre_reminder_time, datetime.timedelta(minutes=15))
+        self.assertEqual(item.repeat_time, item.reminder_time + datetime.timedelta(days=1))
+        self.assertFalse(item.is_pre_reminder_sent or item.is_main_reminder_sent)
+        self.assertEqual((item.next_fire_at, item.next_fire_kind), (item.pre_reminder_time, 'pre'))
+        self.assertEqual(task.reminder_time, reminder_time + datetime.timedelta(weeks=1))
+        self.assertFalse(task.is_transfered)
+        self.assertEqual(collect_due(now), ([], [], [], [], []))
+
+
+class RetentionTests(TestCase):
+    '''
+        Очистка удаляет только завершённые элементы
+    '''
+
+    def test_only_finished_items_are_purged(self):
+        create_user(1)
+        past = timezone.now() - datetime.timedelta(hours=1)
+        finished = [create_reminder(1, past, is_pre_reminder_sent=True, is_main_reminder_sent=True) for _ in range(5)]
+        unsent = create_reminder(1, past)
+        recurring = create_reminder(1, past, repeat_type='daily', is_pre_reminder_sent=True, is_main_reminder_sent=True)
+        completed = create_task(1, past, is_completed=True)
+        open_task = create_task(1, past, is_pre_reminder_sent=True, is_main_reminder_sent=True)
+        recurring_task = create_task(1, past, repeat_type='daily', is_completed=True)
+
+        report = purge_finished(chunk=2, pause=0)
+        self.assertEqual(report['reminders']['rows'], len(finished))
+        self.assertEqual(report['reminders']['chunks'], 3)
+        self.assertEqual(report['tasks']['rows'], 1)
+        self.assertTrue(report['total']['done'])
+        self.assertEqual(set(Reminder.objects.values_list('id', flat=True)), {unsent.id, recurring.id})
+        self.assertEqual(sorted(Task.objects.values_list('id', flat=True)), [open_task.id, recurring_task.id])
+        self.assertEqual(
+            sorted(DeliveryHistory.objects.values_list('item_type', 'item_id', 'status')),
+            sorted([('reminder', item.id, 'sent') for item in finished] + [('task', completed.id, 'completed')]),
+        )
+
+    def test_budget_leaves_rest_for_next_run(self):
+        create_user(1)
+        past = timezone.now() - datetime.timedelta(hours=1)
+        for _ in range(3):
+            create_task(1, past, is_completed=True)
+        self.assertFalse(purge_finished(budget=0, pause=0)['total']['done'])
+        self.assertEqual(Task.objects.count(), 3)
+        purge_finished(pause=0)
+        self.assertEqual(Task.objects.count(), 0)
+
+
+class HistoryRolloverTests(TransactionTestCase):
+    '''
+        Перенос архива за прошлые месяцы в отдельные файлы SQLite
+    '''
+
+    def test_old_months_move_to_files(self):
+        now = timezone.localtime()
+        this_month = now.replace(day=1, hour=12)
+        last_month = (this_month - datetime.timedelta(days=1)).replace(day=1)
+        for archived_at in (last_month, last_month, this_month):
+            DeliveryHistory.objects.create(item_type='task', item_id=1, user_id=1, status='completed',
+                                           reminder_time=now, created_at=now, archived_at=archived_at)
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(HISTORY_ARCHIVE_DIR=Path(directory)):
+            suffix = f'{last_month:%Y_%m}'
+            self.assertEqual(rollover_history(), {suffix: 2})
+            self.assertEqual(DeliveryHistory.objects.count(), 1)
+            with sqlite3.connect(Path(directory) / f'history_{suffix}.sqlite3') as archive:
+                self.assertEqual(archive.execute('SELECT COUNT(*) FROM bot_deliveryhistory').fetchone(), (2,))
+
+
+class DryRunTests(TestCase):
+    '''
+        Прогон рассылки по фиктивным часам
+    '''
+
+    def test_replay_counts_messages_per_step(self):
+        create_user(1)
+        create_user(2)
+        start = timezone.now().replace(second=0, microsecond=0) + datetime.timedelta(hours=1)
+        create_reminder(1, start + datetime.timedelta(minutes=30))
+        create_reminder(2, start + datetime.timedelta(minutes=30))
+        create_reminder(1, start + datetime.timedelta(minutes=31), repeat_type='daily')
+        # Срабатывает до начала прогона: отправляется при перемотке и в пик не попадает
+        create_reminder(2, start - datetime.timedelta(minutes=20))
+
+        report = replay(start, start + datetime.timedelta(minutes=40), step=60)
+        self.assertEqual(report['skipped'], 1)
+        self.assertEqual(len(report['steps']), 41)
+        # Три предварительных и три основных, повторяющееся после отправки переведено на завтра
+        self.assertEqual(report['messages'], 6)
+        self.assertEqual(report['peak_burst'], 2)
+        self.assertEqual(report['peak_at'], start + datetime.timedelta(minutes=15))
+        self.assertEqual(Reminder.objects.get(repeat_type='daily').reminder_time, start + datetime.timedelta(days=1, minutes=31))
+
+
+class PopulationTests(TestCase):
+    '''
+        Генератор нагрузки для бенчмарков
+    '''
+
+    def test_population_is_consistent(self):
+        now = timezone.now()
+        create_population(2000, now, seed=1)
+        self.assertEqual(Reminder.objects.count() + Task.objects.count(), 2000)
+        self.assertEqual(UserProfile.objects.count(), 100)
+        # Повторяющиеся не остаются в прошлом, а готовыми к отправке бывают только элементы последних минут
+        self.assertFalse(Reminder.objects.exclude(repeat_type=None).filter(reminder_time__lte=now - datetime.timedelta(minutes=2)).exists())
+        due = collect_due(now, limit=10000)
+        self.assertTrue(all(item.reminder_time > now - datetime.timedelta(minutes=2) for item in due.reminders + due.tasks))
+        self.assertTrue(Reminder.objects.filter(repeat_type='weekly').exists())
+
+
+class FakeBotAPIMixin:
+    '''
+        Локальная имитация Bot API на свободном порту, telebot направлен на неё
+    '''
+
+    def setUp(self):
+        self.api = FakeBotAPI(latency=0, chat_rate=1)
+        self.server = make_server(self.api, port=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        patcher = mock.patch.multiple(apihelper, API_URL=f'{url}/bot{{0}}/{{1}}', FILE_URL=f'{url}/file/bot{{0}}/{{1}}')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+
+class FakeBotAPITests(FakeBotAPIMixin, TestCase):
+    '''
+        Локальная имитация Bot API
+    '''
+
+    def test_send_limits_and_files(self):
+        bot = TeleBot('1:test', threaded=False)
+        self.assertEqual(bot.send_message(chat_id=5, text='привет').text, 'привет')
+        with self.assertRaises(ApiTelegramException) as context:
+            bot.send_message(chat_id=5, text='ещё')
+        self.assertEqual(context.exception.error_code, 429)
+        self.assertEqual(context.exception.result_json['parameters']['retry_after'], 1)
+        bot.send_message(chat_id=6, text='другой чат')
+
+        file_info = bot.get_file('voice1')
+        self.assertEqual(len(bot.download_file(file_info.file_path)), self.api.file_size)
+        self.assertEqual(self.api.stats()['calls']['sendMessage'], 3)
+        self.assertEqual(self.api.stats()['rejected'], {'chat': 1})
+
+
+def wait_until(condition, timeout: float = 5, message: str = 'Условие не выполнилось'):
+    '''
+        Ожидание условия из другого потока. По истечении timeout тест падает, а не зависает
+    '''
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            raise AssertionError(f'{message} за {timeout} с')
+        time.sleep(0.01)
+
+
+def make_update(update_id: int, chat_id: int = 1, text: str = 'привет') -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+            'text': text,
+        },
+    }
+
+
+class WebhookQueueTests(TransactionTestCase):
+    '''
+        Вебхук ставит обновления в очередь и отвечает, не дожидаясь обработчиков.
+        Потоки пула сами пишут в базу, поэтому тест без общей транзакции
+    '''
+
+    def test_webhook_answers_before_handlers_finish(self):
+        release = threading.Event()
+        handled = []
+
+        def handle(update):
+            release.wait(5)
+            handled.append(update.update_id)
+
+        executor = UpdateExecutor(handle, workers=1, queue_size=1, durable=True)
+        self.addCleanup(executor.close)
+        url = reverse('bot:index')
+        with mock.patch('bot.views.get_update_executor', return_value=executor):
+            started = time.monotonic()
+            # Первое обновление сразу забирает поток, второе ждёт в очереди, третьему места нет
+            self.assertEqual(self.client.post(url, make_update(1), content_type='application/json').status_code, 200)
+            wait_until(lambda: not executor.depth(), message='Поток не забрал первое обновление')
+            self.assertEqual(self.client.post(url, make_update(2), content_type='application/json').status_code, 200)
+            self.assertEqual(self.client.post(url, make_update(3), content_type='application/json').status_code, 429)
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertEqual(self.client.post(url, {'foo': 1}, content_type='application/json').status_code, 400)
+            # Принятые хранятся в базе до конца обработки, отклонённое - нет
+            self.assertEqual(list(IncomingUpdate.objects.values_list('update_id', flat=True).order_by('update_id')), [1, 2])
+            # Повтор ещё не обработанного обновления не ставится в очередь второй раз
+            self.assertEqual(self.client.post(url, make_update(2), content_type='application/json').status_code, 200)
+
+        release.set()
+        executor.join()
+        self.assertEqual(handled, [1, 2])
+        self.assertEqual(list(IncomingUpdate.objects.filter(processed_at__isnull=False).values_list('update_id', flat=True).order_by('update_id')), [1, 2])
+        stats = executor.snapshot()
+        self.assertEqual((stats['accepted'], stats['rejected'], stats['processed'], stats['depth'], stats['stored']), (2, 1, 2, 0, 0))
+
+        # Новый процесс с пустой памятью: повтор уже обработанного отсеивается по отметке в базе
+        restarted = UpdateExecutor(handle, workers=1, dedup=UpdateDeduplicator(), durable=True)
+        self.addCleanup(restarted.close)
+        with mock.patch('bot.views.get_update_executor', return_value=restarted):
+            self.assertEqual(self.client.post(url, make_update(2), content_type='application/json').status_code, 200)
+        restarted.join()
+        self.assertEqual(handled, [1, 2])
+        self.assertEqual(restarted.snapshot()['duplicates'], 1)
+
+        # Старые отметки удаляются (первый проход потока восстановления мог успеть раньше)
+        IncomingUpdate.objects.filter(update_id=1).update(processed_at=timezone.now() - datetime.timedelta(hours=25))
+        restarted.prune()
+        self.assertEqual(list(IncomingUpdate.objects.values_list('update_id', flat=True)), [2])
+
+    def test_own_held_updates_are_not_recovered(self):
+        started = threading.Event()
+        release = threading.Event()
+        handled = []
+
+        def handle(update):
+            started.set()
+            release.wait(5)
+            handled.append(update.update_id)
+
+        # Аренда истекает сразу: обработка и ожидание в очереди длиннее неё
+        with override_settings(UPDATE_LEASE_SECONDS=0, UPDATE_RECOVERY_INTERVAL=3600):
+            executor = UpdateExecutor(handle, workers=1, durable=True)
+            self.addCleanup(executor.close)
+            for update_id in (1, 2):
+                payload = json.dumps(make_update(update_id))
+                executor.submit(Update.de_json(payload), payload=payload)
+            self.assertTrue(started.wait(5))
+            self.assertEqual(executor.recover(), 0)
+            self.assertEqual(executor.renew(), 2)
+            release.set()
+            executor.join()
+        self.assertEqual(handled, [1, 2])
+        self.assertEqual(executor.renew(), 0)
+
+    def test_updates_of_stopped_process_are_recovered(self):
+        # Процесс принял обновления и был перезапущен до обработки: аренда одного истекла, другого - ещё нет
+        now = timezone.now()
+        IncomingUpdate.objects.create(update_id=7, payload=json.dumps(make_update(7, chat_id=2)), lease_owner='old', lease_until=now - datetime.timedelta(seconds=1))
+        IncomingUpdate.objects.create(update_id=8, payload=json.dumps(make_update(8, chat_id=2)), lease_owner='old', lease_until=now + datetime.timedelta(minutes=1))
+        done = threading.Event()
+        handled = []
+
+        def handle(update):
+            handled.append((update.update_id, update.message.chat.id))
+            done.set()
+
+        # Отметка уже учла 7, но подобранное из базы всё равно обрабатывается
+        UpdateWatermark.objects.create(name='updates', update_id=7)
+        executor = UpdateExecutor(handle, workers=1, dedup=UpdateDeduplicator(), durable=True)
+        self.addCleanup(executor.close)
+        self.assertTrue(done.wait(5))
+        executor.join()
+        self.assertEqual(handled, [(7, 2)])
+        self.assertEqual(list(IncomingUpdate.objects.filter(processed_at=None).values_list('update_id', flat=True)), [8])
+
+
+class UpdateDedupTests(TestCase):
+    '''
+        Повторно доставленные обновления не доходят до обработчиков
+    '''
+
+    def test_replays_dropped_before_handlers(self):
+        handled = []
+        executor = UpdateExecutor(lambda update: handled.append(update.update_id), workers=1, dedup=UpdateDeduplicator(flush_interval=60))
+        for update_id in (1, 2, 1, 3, 2):
+            executor.submit(SimpleNamespace(update_id=update_id))
+        executor.close()
+        self.assertEqual(handled, [1, 2, 3])
+        self.assertEqual(executor.snapshot()['duplicates'], 2)
+
+        # После перезапуска память пуста: сохранённая отметка отсекает только номера, отставшие больше чем на окно
+        self.assertEqual(UpdateWatermark.objects.get(name='updates').update_id, 3)
+        UpdateWatermark.objects.filter(name='updates').update(update_id=10)
+        dedup = UpdateDeduplicator(window=3)
+        self.assertFalse(dedup.accept(7))
+        # В пределах окна: могло прийти не по порядку или быть принято другим процессом
+        self.assertTrue(dedup.accept(9))
+        self.assertTrue(dedup.accept(12))
+        self.assertTrue(dedup.accept(11))
+        self.assertFalse(dedup.accept(11))
+        self.assertTrue(dedup.accept(13))
+        # 9 вытеснено из памяти и отстало от 13 больше чем на окно
+        self.assertFalse(dedup.accept(9))
+        dedup.flush()
+        self.assertEqual(UpdateWatermark.objects.get(name='updates').update_id, 13)
+
+
+class ShardedUpdatesTests(TestCase):
+    '''
+        Обновления одного чата идут по порядку, разные чаты не ждут друг друга
+    '''
+
+    def test_slow_chat_does_not_block_others(self):
+        release = threading.Event()
+        handled = []
+
+        def handle(update):
+            if update.update_id == 1:
+                release.wait(5)
+            handled.append(update.update_id)
+
+        executor = UpdateExecutor(handle, workers=2)
+        self.addCleanup(executor.close)
+        for update_id, chat_id in ((1, 2), (2, 2), (3, 3)):
+            executor.submit(Update.de_json(make_update(update_id, chat_id=chat_id)))
+        executor.queues[1].join()
+        self.assertEqual(handled, [3])
+
+        release.set()
+        executor.join()
+        self.assertEqual(handled, [3, 1, 2])
+
+
+class RoutingTests(TestCase):
+    '''
+        Маршрутизация обновлений по таблице
+    '''
+
+    def test_routes_by_table_and_state(self):
+        from . import SettingsStates, bot
+        from . import views
+
+        patched = {name: mock.patch(f'bot.views.{name}').start() for name in ('cmd_start', 'final_sets', 'handle_text', 'reminder_button', 'task_sets', 'handle_voice')}
+        self.addCleanup(mock.patch.stopall)
+        callback = make_update(5)
+        callback['callback_query'] = {'id': '1', 'from': callback['message']['from'], 'chat_instance': '1', 'data': 't.finish|7', 'message': callback.pop('message')}
+
+        for update in (make_update(1, text='/start'), make_update(2, text='привет'), make_update(3, text='⚙️ Задача'), callback):
+            views.process_update(Update.de_json(update))
+        bot.set_state(1, SettingsStates.timezone, 1)
+        self.addCleanup(bot.delete_state, 1, 1)
+        # В состоянии выбора часового пояса текст уходит в настройку, а кнопки меню работают как обычно
+        views.process_update(Update.de_json(make_update(6, text='+3')))
+        views.process_update(Update.de_json(make_update(7, text='⚙️ Задача')))
+
+        self.assertEqual({name: handler.call_count for name, handler in patched.items()}, {
+            'cmd_start': 1, 'final_sets': 1, 'handle_text': 1, 'reminder_button': 2, 'task_sets': 1, 'handle_voice': 0,
+        })
+        stats = views.router.stats.snapshot()
+        self.assertEqual(stats['routes']['m_reminder_button'], 2)
+        self.assertGreater(stats['routing_p99_us'], 0)
+
+
+class PollingTests(FakeBotAPIMixin, TestCase):
+    '''
+        Режим опроса getUpdates
+    '''
+
+    def test_updates_confirmed_after_handlers(self):
+        for i in range(30):
+            self.api.push_update(chat_id=i % 4, text=f'сообщение {i}')
+        handled = []
+        release = threading.Event()
+
+        def handle(update):
+            # Первое обновление задерживает свой чат: остальные чаты обрабатываются, но offset не уходит дальше него
+            if update.update_id == 1:
+                release.wait(5)
+            handled.append(update.update_id)
+
+        poller = Poller(TeleBot('1:test', threaded=False), handle, workers=4, timeout=1, busy_interval=0.05)
+        thread = threading.Thread(target=poller.run)
+        thread.start()
+        self.addCleanup(thread.join, 10)
+        self.addCleanup(poller.stop)
+        self.addCleanup(release.set)
+        # У чата 0 из 30 обновлений 8, все они ждут первого
+        wait_until(lambda: len(handled) >= 22, message='Не обработаны обновления незадержанных чатов')
+        self.assertEqual(poller.offset(), 1)
+        self.assertEqual(self.api.stats()['pending_updates'], 30)
+
+        release.set()
+        wait_until(lambda: poller.offset() == 31, message='Обновления не подтверждены')
+        poller.stop()
+        thread.join(10)
+        self.assertEqual(sorted(handled), list(range(1, 31)))
+        self.assertEqual(self.api.stats()['pending_updates'], 0)
+        self.assertEqual(poller.snapshot()['depth'], 0)
+
+
+class BotIdentityTests(FakeBotAPIMixin, TestCase):
+    '''
+        getMe запрашивается один раз и дальше берётся из файла
+    '''
+
+    def test_identity_cached_on_disk(self):
+        cache = Path(tempfile.mkdtemp()) / 'identity.json'
+        bot = TeleBot('1:test', threaded=False)
+        with override_settings(BOT_IDENTITY_CACHE=cache, BOT_TOKEN='1:test'), mock.patch.object(identity, 'identity', None):
+            self.assertEqual(identity.setup_bot(bot)['username'], 'fake_bot')
+            self.assertEqual(identity.get_identity(bot)['id'], 1)
+            # Новый процесс: память пуста, но файл уже есть
+            identity.identity = None
+            self.assertEqual(identity.get_identity(bot)['username'], 'fake_bot')
+            self.assertEqual(self.api.stats()['calls'], {'setMyCommands': 1, 'getMe': 1})
+
+        # Кэш другого бота не используется
+        with override_settings(BOT_IDENTITY_CACHE=cache, BOT_TOKEN='2:other'), mock.patch.object(identity, 'identity', None):
+            identity.get_identity(bot)
+            self.assertEqual(self.api.stats()['calls']['getMe'], 2)
+
+
+class SchedulerTests(TestCase):
+    '''
+        Планировщик будит рассылку только когда есть что отправить
+    '''
+
+    def setUp(self):
+        create_user(1)
+        create_user(2)
+        UserProfile.objects.filter(user_id=2).update(is_blocked=True)
+        self.now = timezone.now()
+        self.send = mock.Mock(side_effect=lambda: enqueue_due(now=self.now))
+        self.scheduler = Scheduler(self.send, horizon=3600, reload_interval=10)
+
+    def test_blocked_users_do_not_refire(self):
+        create_reminder(1, self.now + datetime.timedelta(minutes=5))
+        create_reminder(2, self.now - datetime.timedelta(minutes=1))
+        self.scheduler.tick(self.now)
+        self.assertEqual(self.send.call_count, 1)
+        # После отправки в куче только следующее срабатывание активного пользователя
+        self.assertEqual([model for _, model, _ in self.scheduler.heap], ['reminder'])
+        self.assertGreater(self.scheduler.heap[0][0], self.now)
+
+        for seconds in (10, 20, 30):
+            self.scheduler.tick(self.now + datetime.timedelta(seconds=seconds))
+        self.assertEqual(self.send.call_count, 1)
+
+    def test_load_new_and_reload_fired(self):
+        self.scheduler.tick(self.now)
+        self.assertEqual(self.scheduler.heap, [])
+        reminder = create_reminder(1, self.now + datetime.timedelta(minutes=30))
+        task = create_task(1, self.now - datetime.timedelta(hours=1), is_pre_reminder_sent=True, is_main_reminder_sent=True)
+        Task.objects.filter(id=task.id).update(is_transfered=True, transfer_time=self.now + datetime.timedelta(minutes=1), next_fire_at=self.now + datetime.timedelta(minutes=1), next_fire_kind='transfer')
+        create_reminder(2, self.now + datetime.timedelta(minutes=10))
+
+        # Догрузка: новая строка по id, перенос существующей - отдельным запросом
+        self.scheduler.tick(self.now + datetime.timedelta(seconds=10))
+        self.assertEqual(sorted((model, item_id) for _, model, item_id in self.scheduler.heap), [('reminder', reminder.id), ('task', task.id)])
+
+        # Сработавший перенос перечитывается из базы: next_fire_at сброшен, задача из кучи уходит
+        self.now += datetime.timedelta(minutes=6)
+        self.scheduler.tick(self.now)
+        self.assertEqual(self.send.call_count, 1)
+        reminder.refresh_from_db()
+        self.assertEqual(self.scheduler.heap, [(reminder.next_fire_at, 'reminder', reminder.id)])
+
+        # Предварительное напоминание: после отправки в кучу попадает основное время
+        self.now = reminder.pre_reminder_time
+        self.scheduler.tick(self.now)
+        reminder.refresh_from_db()
+        self.assertEqual(self.scheduler.heap, [(reminder.reminder_time, 'reminder', reminder.id)])
+
+
+    def test_unblocked_user_rows_return_before_full_reload(self):
+        overdue = create_reminder(2, self.now - datetime.timedelta(minutes=1))
+        self.scheduler.tick(self.now)
+        self.assertEqual(self.scheduler.heap, [])
+
+        # Пользователь снова нажал /start: строка возвращается при ближайшей догрузке, а не через горизонт
+        UserProfile.objects.filter(user_id=2).update(is_blocked=False)
+        self.now += datetime.timedelta(seconds=10)
+        self.scheduler.tick(self.now)
+        self.assertEqual(self.send.call_count, 1)
+        overdue.refresh_from_db()
+        self.assertTrue(overdue.is_main_reminder_sent)
+
+
+class BenchmarkIsolationTests(TransactionTestCase):
+    '''
+        Сценарий вне транзакции не трогает настоящую очередь
+    '''
+
+    def test_workers_scenario_leaves_real_rows(self):
+        real = Outbox.objects.create(key='reminder:1:1', chat_id=1, kind='reminder', item_id=1, text='Настоящее', due_at=timezone.now())
+        # Один обработчик: тестовая SQLite в памяти не ждёт снятия блокировки, параллельная запись падала бы
+        results = bench_workers([1], messages=20, latency=0)
+        self.assertEqual(results[0]['sent'], 20)
+        real.refresh_from_db()
+        self.assertEqual((real.status, real.attempts, real.lease_owner), ('pending', 0, ''))
+        self.assertEqual(Outbox.objects.count(), 1)
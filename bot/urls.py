@@ -9,5 +9,6 @@ app_name = 'bot'
 
 urlpatterns = [
     path(settings.BOT_TOKEN, views.index, name="index"),
+    path(f'{settings.BOT_TOKEN}/stats', views.update_stats, name="update_stats"),
     path('', views.set_webhook, name="set_webhook"),
 ]
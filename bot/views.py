@@ -3,7 +3,6 @@ from traceback import format_exc
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_GET, require_POST
-from asgiref.sync import sync_to_async
 from django.http import HttpRequest, JsonResponse
 from django.conf import settings
 
@@ -11,33 +10,32 @@ from telebot.apihelper import ApiTelegramException
 from telebot.types import Update
 
 from bot import bot, logger, SettingsStates
+from bot.services.identity import setup_bot
+from bot.services.routing import Router
+from bot.services.updates import QueueFull, get_update_executor
 from bot.handlers.reminder import *
 from bot.handlers.menu import *
 from bot.handlers.common import *
 
+# Состояние пользователя проверяется один раз на сообщение, в самом маршрутизаторе
+router = Router(state_of=bot.get_state)
+
 
 @require_GET
 def set_webhook(request: HttpRequest) -> JsonResponse:
     '''
         Установка вебхуков со стороны бота
     '''
+    setup_bot(bot)
     bot.set_webhook(url=f"{settings.HOOK}/bot/{settings.BOT_TOKEN}", allowed_updates=['message', 'callback_query'])
     bot.send_message(settings.OWNER_ID, "webhook set")
     return JsonResponse({"message": "OK"}, status=200)
 
 
-@csrf_exempt
-@require_POST
-@sync_to_async
-def index(request: HttpRequest) -> JsonResponse:
+def process_update(update: Update):
     '''
-        Установка вебхуков со стороны сайта
+        Обработка одного обновления (в потоке пула обработки)
     '''
-    if request.META.get("CONTENT_TYPE") != "application/json":
-        return JsonResponse({"message": "Bad Request"}, status=403)
-
-    json_string = request.body.decode("utf-8")
-    update = Update.de_json(json_string)
     try:
         bot.process_new_updates([update])
     except ApiTelegramException as e:
@@ -47,10 +45,45 @@ def index(request: HttpRequest) -> JsonResponse:
     except Exception as e:
         bot.send_message(settings.OWNER_ID, f'Error from index: {e}')
         logger.error(f"Unhandled exception. {e} {format_exc()}")
+
+
+@csrf_exempt
+@require_POST
+def index(request: HttpRequest) -> JsonResponse:
+    '''
+        Установка вебхуков со стороны сайта.
+        Обновление только проверяется, сохраняется в базе и ставится в очередь, обработка идёт в пуле потоков
+    '''
+    if request.META.get("CONTENT_TYPE") != "application/json":
+        return JsonResponse({"message": "Bad Request"}, status=403)
+
+    try:
+        payload = request.body.decode("utf-8")
+        update = Update.de_json(payload)
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"message": "Bad Request"}, status=400)
+    if update is None or not isinstance(update.update_id, int):
+        return JsonResponse({"message": "Bad Request"}, status=400)
+
+    try:
+        get_update_executor(process_update).submit(update, payload=payload)
+    except QueueFull:
+        # Не 200: Telegram повторит обновление, когда очередь разгрузится
+        return JsonResponse({"message": "Too Many Requests"}, status=429)
     return JsonResponse({"message": "OK"}, status=200)
 
 
-@bot.message_handler(commands=['start'])
+@require_GET
+def update_stats(request: HttpRequest) -> JsonResponse:
+    '''
+        Состояние очереди входящих обновлений и статистика маршрутизации
+    '''
+    snapshot = get_update_executor(process_update).snapshot()
+    snapshot['routing'] = router.stats.snapshot()
+    return JsonResponse(snapshot, status=200)
+
+
+@router.command('start')
 def m_cmd_start(message: Message):
     '''
         Обработчик команды старт
@@ -62,7 +95,7 @@ def m_cmd_start(message: Message):
         print(e)
 
 
-@bot.message_handler(state=SettingsStates.timezone.name)
+@router.state(SettingsStates.timezone.name)
 def m_final_sets(message: Message):
     '''
         Установка параметров для пользователя
@@ -74,7 +107,7 @@ def m_final_sets(message: Message):
         logger.error(f'При установке параметров для пользователя возникла ошибка: {e}')
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('o'))
+@router.callback('o')
 def m_selected_addressing(call: CallbackQuery):
     '''
         Выбор обращения к пользователю
@@ -86,7 +119,7 @@ def m_selected_addressing(call: CallbackQuery):
         logger.error(f'При выборе обращения к пользователю возникла ошибка: {e}')
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('f'))
+@router.callback('f')
 def m_selected_tone(call: CallbackQuery):
     '''
         Выбор тона разговора
@@ -98,7 +131,7 @@ def m_selected_tone(call: CallbackQuery):
         logger.error(f'При выборе тона общения возникла ошибка: {e}')
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('t'))
+@router.callback('t')
 def m_task_sets(call: CallbackQuery):
     '''
         Действия с задачей (Завершить, перенести, удалить)
@@ -110,7 +143,7 @@ def m_task_sets(call: CallbackQuery):
         logger.error(f'При работе с задачей возникла ошибка: {e}')
 
 
-@bot.message_handler(func=lambda message: message.text == '📝 Напоминание' or message.text == '⚙️ Задача')
+@router.text('📝 Напоминание', '⚙️ Задача')
 def m_reminder_button(message: Message):
     '''
         Кнопка создания напоминания
@@ -122,7 +155,7 @@ def m_reminder_button(message: Message):
        logger.error(f'При начале работы с напоминанием возникла ошибка: {e}')
 
 
-@bot.message_handler(func=lambda message: message.text == '📋 Все напоминания и задачи')
+@router.text('📋 Все напоминания и задачи')
 def m_list_reminders(message: Message):
     '''
         Кнопка всех напоминаний
@@ -134,7 +167,7 @@ def m_list_reminders(message: Message):
         logger.error(f'При выведении списка напоминаний возникла ошибка: {e}')
 
 
-@bot.message_handler(content_types=['voice'])
+@router.content('voice')
 def m_handle_voice(message: Message):
     '''
         Обработка голоса
@@ -146,19 +179,16 @@ def m_handle_voice(message: Message):
         logger.error(f'При обработке возникла ошибка {e}')
 
 
-@bot.message_handler(content_types=['text'])
+@router.content('text')
 def m_handle_text(message: Message):
     '''
         Обработка текста
     '''
-    if bot.get_state(message.from_user.id) == SettingsStates.timezone.name:
-        try:
-            final_sets(message, bot)
-        except Exception as e:
-            logger.error(f'При установке параметров для пользователя возникла ошибка: {e}')
-
-    else:
-        try:
-            handle_text(message=message, bot=bot)
-        except Exception as e:
-            logger.error(f'При обработке текста возникла ошибка: {e}')
\ No newline at end of file
+    try:
+        handle_text(message=message, bot=bot)
+    except Exception as e:
+        logger.error(f'При обработке текста возникла ошибка: {e}')
+
+
+# Два обработчика в боте вместо цепочки фильтров: дальше маршрут выбирается по таблице
+router.install(bot)
@@ -36,12 +36,87 @@ ALLOWED_HOSTS = ['*']
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 HOOK = 'https://jdv1i7-176-52-15-111.ru.tuna.am'
 OWNER_ID = os.getenv('OWNER_ID')
+# Адрес Bot API, например http://127.0.0.1:8081 для локальной имитации (manage.py fake_bot_api). Пусто - api.telegram.org
+BOT_API_URL = os.getenv('BOT_API_URL')
+# Кэш ответа getMe, чтобы запуск процесса не ходил в Bot API
+BOT_IDENTITY_CACHE = BASE_DIR / '.bot_identity.json'
 BOT_NAME = 'Тоби'
 BOT_COMMANDS = [
     BotCommand("start", "Старт"),
 ]
 
 REMINDER_CHECK_INTERVAL = 60
+# Максимум строк каждой модели, выбираемых за один проход рассылки
+DUE_BATCH_SIZE = 500
+
+# Настройки планировщика (run_scheduler), в секундах
+SCHEDULER_HORIZON = 60 * 60
+SCHEDULER_RELOAD_INTERVAL = 10
+SCHEDULER_CLEANUP_INTERVAL = 60 * 10
+
+# Настройки пула отправки: лимиты Telegram ~30 сообщений в секунду на бота и 1 в секунду на чат
+DELIVERY_WORKERS = 8
+DELIVERY_GLOBAL_RATE = 30
+# Сколько процессов разбирают Outbox одновременно (minute_task, drain_outbox). Лимит бота общий на токен,
+# поэтому DELIVERY_GLOBAL_RATE делится между ними: иначе N процессов отправляли бы N×30 сообщений в секунду
+DELIVERY_PROCESSES = 1
+DELIVERY_CHAT_RATE = 1
+DELIVERY_MAX_RETRIES = 3
+DELIVERY_QUEUE_SIZE = 1000
+# Пауза перед повтором после 429/5xx/сетевой ошибки: 30 с, 60 с, 120 с ... не больше часа
+DELIVERY_BACKOFF_BASE = 30
+DELIVERY_BACKOFF_MAX = 60 * 60
+# Ошибок 5xx/сети подряд, после которых отправка приостанавливается, и длительность паузы в секундах
+CIRCUIT_BREAKER_THRESHOLD = 10
+CIRCUIT_BREAKER_COOLDOWN = 60
+
+# Настройки очереди исходящих сообщений (Outbox)
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_LEASE_SECONDS = 60 * 5
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_POLL_INTERVAL = 1
+# Если у пользователя в пачке больше DIGEST_THRESHOLD сообщений без кнопок, они уходят одной сводкой.
+# Сводка из сообщений, опоздавших больше чем на DIGEST_CATCHUP_MINUTES минут, оформляется как пропущенное за время простоя
+DIGEST_THRESHOLD = 2
+DIGEST_CATCHUP_MINUTES = 30
+# Ограничение Telegram на длину одного сообщения
+MESSAGE_MAX_LENGTH = 4096
+
+# Настройки пула обработки входящих обновлений: потоки и размер очереди.
+# При заполненной очереди вебхук отвечает 429, и Telegram повторяет обновление позже
+UPDATE_WORKERS = 8
+UPDATE_QUEUE_SIZE = 1000
+# Принятые обновления хранятся в базе до конца обработки. Аренда (в секундах) - сколько строка считается
+# занятой своим процессом; раз в UPDATE_RECOVERY_INTERVAL секунд процесс продлевает аренду своих строк
+# и подбирает просроченные (процесс перезапущен). Аренда должна быть заметно длиннее интервала
+UPDATE_LEASE_SECONDS = 120
+UPDATE_RECOVERY_INTERVAL = 30
+# Сколько часов хранить номера обработанных обновлений для отсева повторов (Telegram хранит обновления до суток)
+UPDATE_PROCESSED_KEEP_HOURS = 24
+# Сколько последних update_id помнить для отсева повторов и как часто (в секундах) сохранять наибольший принятый
+UPDATE_DEDUP_WINDOW = 10000
+UPDATE_WATERMARK_FLUSH_INTERVAL = 1
+
+# Настройки режима опроса (run_polling): обновлений за запрос, ожидание getUpdates в секундах,
+# пауза между повторными запросами, пока обновления ещё обрабатываются, и период записи метрик очереди в лог
+POLLING_LIMIT = 100
+POLLING_TIMEOUT = 25
+POLLING_BUSY_INTERVAL = 0.5
+POLLING_STATS_INTERVAL = 60
+
+# Настройки очистки завершённых элементов: размер порции, пауза между порциями и бюджет времени на запуск, в секундах
+RETENTION_CHUNK_SIZE = 500
+RETENTION_PAUSE = 0.05
+RETENTION_TIME_BUDGET = 5
+# Сколько дней хранить отправленные и окончательно не отправленные сообщения очереди
+RETENTION_OUTBOX_DAYS = 7
+# Куда складываются ежемесячные файлы архива DeliveryHistory (только для SQLite)
+HISTORY_ARCHIVE_DIR = BASE_DIR / 'archive'
+
+# Сколько дней хранить метрики проходов рассылки (DispatchTick)
+METRICS_RETENTION_DAYS = 7
+# Верхние границы корзин гистограммы опоздания отправки, в секундах
+LATENESS_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
 
 
 # Application definition